@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+from VISA_Driver import VISA_Driver
+import InstrumentDriver
+import numpy as np
+import time
+
+__version__ = "0.0.1"
+
+
+class Driver(VISA_Driver):
+    """
+    This class implements the Agilent 34401A digital multimeter driver. Readings of one point are stored in the
+    internal reading memory of the instrument (up to 512 readings) and fetched with one FETC? query, instead of one
+    :READ? round trip per reading.
+    """
+
+    # Quantities that return a single number of the currently selected function (mean of the acquired buffer)
+    reading_quantities = ["Voltage", "Current", "Resistance"]
+    # Quantities that are calculated from the same acquired buffer
+    buffer_quantities = ["Reading trace", "Reading mean", "Reading std"]
+    # Quantities that are used only by the driver, nothing is sent to the instrument when they are set
+    driver_quantities = ["Samples per point", "Triggered readings", "Trigger timeout", "Integration mode",
+                         "Noise target", "Noise estimate readings"]
+
+    # Time to wait between two checks of the status byte while the instrument is measuring
+    poll_interval = 0.005
+    # Bit of the status byte that summarizes the standard event status register (operation complete bit is enabled)
+    ESB_BIT = 32
+
+    # NPLC command prefix, range and auto-range quantities of the functions that integrate (AC functions do not)
+    nplc_functions = {"Voltage DC": ("VOLT:DC", "Range (V_dc)", "Auto-range (V_dc)"),
+                      "Current DC": ("CURR:DC", "Range (I_dc)", "Auto-range (I_dc)"),
+                      "Resistance (2-wire)": ("RES", "Range (R-2w)", "Auto-range (R-2w)"),
+                      "Resistance (4-wire)": ("FRES", "Range (R-4w)", "Auto-range (R-4w)")}
+    # Integration times (in power line cycles) available in the auto integration mode, from fastest to slowest
+    nplc_values = [0.02, 0.2, 1.0, 10.0, 100.0]
+
+    def performOpen(self, options={}):
+        """
+        Perform the operation of opening the instrument connection. Operation complete event is enabled in the standard
+        event status register, so the end of an acquisition can be seen in the status byte without a blocking query.
+
+        :param options:
+        :return: NoneType
+        """
+        VISA_Driver.performOpen(self, options=options)
+
+        self.write("*ESE 1")
+        self.reading_buffer = None
+        # number of readings of the acquisition that takes one reading per external trigger (0 if not armed)
+        self.triggered_samples = 0
+        self.triggered_buffer = None
+        # integration time selected by the auto integration mode for every (function, range) pair
+        self.nplc_cache = {}
+        self.active_nplc = None
+
+    def performSetValue(self, quant, value, sweepRate=0.0, options={}):
+        """
+        Perform the Set Value instrument operation. This function should return the actual value set by the instrument
+
+        :param quant: Quantity object (I believe Labber has some kind of object representing quantities)
+        :type quant:
+        :param value: Value to which the quantity is being set to
+        :type value: int | float | str | bool
+        :param sweepRate:
+        :type sweepRate:
+        :param options:
+        :return: Value that has been passed to this method as the value we want to set the quantity to
+        :rtype: None | int | float | str | bool
+        """
+        if quant.name in ["Noise target", "Noise estimate readings"]:
+            self.nplc_cache = {}
+        elif quant.name == "Integration mode" and value == "Fixed":
+            # put back the integration times selected by the user, only those that are set in NPLC (Integration time
+            # (V_dc) is an aperture, which this model does not support)
+            for name in ["Integration time (I_dc)", "Integration time (R-2w)", "Integration time (R-4w)"]:
+                self.sendValueToOther(name, self.getValue(name))
+        if quant.name in self.driver_quantities:
+            return value
+        # any instrument setting can change the integration time, make the auto mode send it again
+        self.active_nplc = None
+
+        if quant.name == "Arm triggered acquisition":
+            self.arm_triggered_acquisition(int(self.getValue("Triggered readings")))
+            return value
+
+        value = VISA_Driver.performSetValue(self, quant, value, sweepRate, options)
+        return value
+
+    def performGetValue(self, quant, options={}):
+        """
+        Perform the Get Value instrument operation. All reading quantities share one acquisition per call cycle, so
+        getting the mean, the standard deviation and the trace of the same point costs one transfer.
+
+        :param quant: Quantity object (I believe Labber has some kind of class representing quantities)
+        :type quant:
+        :param options:
+        :type options:
+        :return:
+        :rtype: None | int | float | str | bool | dict
+        """
+        if self.isFirstCall(options):
+            self.reading_buffer = None
+
+        if quant.name == "Triggered trace":
+            if self.triggered_samples:
+                self.triggered_buffer = self.fetch_triggered_acquisition()
+            if self.triggered_buffer is None:
+                return quant.getTraceDict([])
+            return quant.getTraceDict(self.triggered_buffer, t0=0.0, dt=1.0)
+
+        if quant.name in self.reading_quantities + self.buffer_quantities:
+            if self.reading_buffer is None and self.triggered_samples:
+                # a new acquisition would throw away the armed triggered acquisition, it is kept until it is fetched
+                self.log("{} is not measured while a triggered acquisition is armed, last value is returned".format(
+                    quant.name))
+                return quant.getValue()
+            if self.reading_buffer is None:
+                if self.getValue("Integration mode") == "Auto":
+                    self.select_integration_time()
+                self.reading_buffer = self.acquire(int(self.getValue("Samples per point")))
+            data = self.reading_buffer
+
+            if quant.name == "Reading trace":
+                return quant.getTraceDict(data, t0=0.0, dt=1.0)
+            elif quant.name == "Reading std":
+                return np.std(data, ddof=1) if len(data) > 1 else 0.0
+            else:
+                return np.mean(data)
+
+        if quant.name == "Selected NPLC":
+            return self.active_nplc if self.active_nplc is not None else 0.0
+
+        value = VISA_Driver.performGetValue(self, quant, options)
+        return value
+
+    def acquire(self, samples):
+        """
+        Take a number of readings with one trigger and fetch them all in one transfer.
+
+        :param samples: Number of readings to take (the reading memory holds up to 512)
+        :type samples: int
+        :return: Readings taken by the instrument
+        :rtype: np.ndarray
+        """
+        # *OPC sets the operation complete bit once all the readings are stored in the memory
+        self.write("*CLS;:SAMP:COUN {};:TRIG:COUN 1;:INIT;*OPC".format(samples))
+        self.wait_for_readings()
+        return self.fetch_readings()
+
+    def select_integration_time(self):
+        """
+        Configure the smallest integration time that meets the noise target for the current function and range. The
+        choice is estimated once for every (function, range) pair and cached, so it is only revisited when the range
+        (or the noise target) changes.
+
+        :return: NoneType
+        """
+        function = self.getValue("Function")
+        if function not in self.nplc_functions:
+            return
+        prefix, range_quant, auto_range_quant = self.nplc_functions[function]
+        if self.getValue(auto_range_quant) == "On":
+            key = (function, "Auto")
+        else:
+            key = (function, self.getValue(range_quant))
+
+        if key not in self.nplc_cache:
+            self.nplc_cache[key] = self.estimate_integration_time(prefix)
+            self.active_nplc = self.nplc_cache[key]
+        if self.active_nplc != self.nplc_cache[key]:
+            self.write(":{}:NPLC {}".format(prefix, self.nplc_cache[key]))
+            self.active_nplc = self.nplc_cache[key]
+
+    def estimate_integration_time(self, prefix):
+        """
+        Find the smallest NPLC whose noise (standard deviation of a short burst of readings) is below the noise target.
+        White noise averages down as 1/sqrt(integration time), so after each burst the settings that can not reach the
+        target are skipped instead of measured.
+
+        :param prefix: NPLC command prefix of the current function (VOLT:DC, CURR:DC, RES or FRES)
+        :type prefix: str
+        :return: Selected NPLC, it is also left configured on the instrument
+        :rtype: float
+        """
+        target = self.getValue("Noise target")
+        samples = int(self.getValue("Noise estimate readings"))
+
+        nplc = self.nplc_values[0]
+        while True:
+            self.write(":{}:NPLC {}".format(prefix, nplc))
+            noise = np.std(self.acquire(samples), ddof=1)
+            if noise <= target or nplc == self.nplc_values[-1]:
+                return nplc
+            required = nplc * (noise / target) ** 2
+            slower = [value for value in self.nplc_values if value > nplc]
+            nplc = next((value for value in slower if value >= required), self.nplc_values[-1])
+
+    def arm_triggered_acquisition(self, samples):
+        """
+        Arm an acquisition that takes one reading on every external trigger. Readings stay in the reading memory until
+        the whole trace is fetched, so a sweep of a source that sends the triggers needs no DMM traffic per point.
+
+        :param samples: Number of triggers (and readings) to expect
+        :type samples: int
+        :return: NoneType
+        """
+        self.write("*CLS;:TRIG:SOUR EXT;:TRIG:COUN {};:SAMP:COUN 1;:INIT;*OPC".format(samples))
+        self.triggered_samples = samples
+
+    def fetch_triggered_acquisition(self):
+        """
+        Wait for the armed triggered acquisition to finish (or the trigger timeout to pass), fetch all of its readings
+        in one transfer and return the instrument to immediate triggering.
+
+        :return: Readings taken on the external triggers, fewer than armed (or empty) if not all the triggers arrived
+        :rtype: np.ndarray
+        """
+        samples = self.triggered_samples
+        self.triggered_samples = 0
+        if self.wait_for_readings(self.getValue("Trigger timeout")):
+            data = self.fetch_readings()
+        else:
+            # readings taken before the device clear stay in the reading memory, with no readings FETC? is not
+            # answered
+            try:
+                data = self.fetch_readings()
+            except InstrumentDriver.Error:
+                data = np.array([])
+            self.log("Triggered acquisition received {} of {} triggers".format(len(data), samples))
+        self.write(":TRIG:SOUR IMM")
+        return data
+
+    def wait_for_readings(self, timeout=None):
+        """
+        Wait until the running acquisition is complete. Status byte is read with a serial poll, which is answered
+        even while the instrument is busy measuring and does not block the bus.
+
+        :param timeout: Maximum time to wait in seconds, None to wait until the measurement is stopped
+        :type timeout: float
+        :return: True if the acquisition is complete, False if the wait was interrupted
+        :rtype: bool
+        """
+        start = time.time()
+        while not self.com.read_stb() & self.ESB_BIT:
+            if self.isStopped() or (timeout is not None and time.time() - start > timeout):
+                # 34401A has no ABORt command, device clear stops the measurement
+                self.com.clear()
+                return False
+            self.wait(self.poll_interval)
+        return True
+
+    def fetch_readings(self):
+        """
+        Fetch all the readings from the reading memory. The instrument replies with comma separated values which are
+        converted to an array in one call.
+
+        :return: Readings stored in the instrument memory
+        :rtype: np.ndarray
+        """
+        return np.fromstring(self.askAndLog(":FETC?"), sep=",")
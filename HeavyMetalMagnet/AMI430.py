@@ -4,8 +4,12 @@ import numpy as np
 import os.path
 import logging
 import socket
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from BaseDriver import LabberDriver
+from trajectory_planner import plan_trajectory, segment_is_safe
+from telemetry import TelemetryRecorder
 
 
 class Driver(LabberDriver):
@@ -30,7 +34,38 @@ class Driver(LabberDriver):
     z_magnet_PORT = 7180
 
     BUFFSIZE = 1024
+    # Time (seconds) to wait for a magnet to accept the connection, if the Labber address config has no timeout
+    connect_timeout = 0.6
+    # Field rating (T) of the x, y and z magnet, upper bound of the last segment of a ramp table
+    field_ratings = {"x": 1.01, "y": 0.98, "z": 5.99}
+    # Every reply of the instrument ends with this terminator, commands end with a line feed
+    TERMINATOR = b"\r\n"
+    # Maximum time (seconds) to wait for the reply to a query
+    reply_timeout = 2.0
+    # Unread data (welcome message, late replies) is considered complete after the instrument is silent this long (s)
+    banner_timeout = 0.3
+    # Shortest and longest time (seconds) between two status polls while waiting for a ramp
+    min_poll_interval = 0.05
+    max_poll_interval = 5.0
+    # Part of the predicted time until the next event (target or safety threshold reached) to sleep before polling
+    poll_fraction = 0.5
+    # Time (seconds) it takes to ramp one segment of an arc sweep, when the sweep goes as fast as the magnets allow
+    arc_segment_time = 2.0
+    # Next set point of an arc sweep is sent when the magnets are this close (seconds) to the current one
+    arc_lead_time = 0.5
+    # Field (T) further than this from the start of an arc sweep is ramped to the start before the sweep begins
+    arc_start_tolerance = 1e-3
+    # Time (seconds) between two status polls while waiting for switch heater and persistent mode transitions
+    switch_poll_interval = 0.2
+    # Queries of the status snapshot, sent in one line and answered in this order. Current is derived from the field
+    # and the coil constant, CURR:MAG? is only added to every current_check_interval-th snapshot
+    status_queries = ["STATE?", "FIELD:MAG?", "FIELD:TARG?", "PERS?", "QU?"]
+    # Measured current that differs from the derived one by more than this fraction, causes the coil constant to be read
+    # again
+    coil_constant_tolerance = 0.01
     CONNECTED_MAGNETS = {"x": False, "y": False, "z": False}
+    # Global quantities that need all three magnets to be connected
+    vector_quantities = ("radius", "theta", "phi")
 
     radius = 0
     theta = 0
@@ -42,6 +77,9 @@ class Driver(LabberDriver):
     restart_all_threshold = 0.80  # When the field falls to ≈90% of max value, restart ramping
     # Stop treshold should be at 0.85 (for testing purposes it is changed to whatever number i find suitable)
     stop_threshold = 0.85  # When the field reaches close to 3 Tesla, stop magnets that are increasing it
+    # Planned paths and arc sweeps stay this far inside combined_field_limit, so that a small overshoot of the supplies
+    # does not make the monitor abort the ramp
+    trajectory_margin = 0.01
 
     """
     # ####################################
@@ -59,33 +97,66 @@ class Driver(LabberDriver):
                         successfully opened, False if it failed.
         :rtype: tuple
         """
-        try:
-            self.x_magnet_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.x_magnet_socket.settimeout(0.6)
-            self.x_magnet_socket.connect((self.x_magnet_IP, self.x_magnet_PORT))
-        except Exception as e:
-            print(str(e))
-        else:
-            self.CONNECTED_MAGNETS["x"] = True
-            self._receive(self.x_magnet_socket)
-        try:
-            self.y_magnet_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.y_magnet_socket.settimeout(0.6)
-            self.y_magnet_socket.connect((self.y_magnet_IP, self.y_magnet_PORT))
-        except Exception as e:
-            print(str(e))
-        else:
-            self.CONNECTED_MAGNETS["y"] = True
-            self._receive(self.y_magnet_socket)
-        try:
-            self.z_magnet_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.z_magnet_socket.settimeout(0.6)
-            self.z_magnet_socket.connect((self.z_magnet_IP, self.z_magnet_PORT))
-        except Exception as e:
-            print(str(e))
-        else:
-            self.CONNECTED_MAGNETS["z"] = True
-            self._receive(self.z_magnet_socket)
+        # bytes received after the last complete reply, for every magnet socket
+        self.receive_buffers = {}
+        # one worker per magnet, so the three supplies can be queried at the same time
+        self.poll_pool = ThreadPoolExecutor(max_workers=3)
+        # last status snapshot of every magnet socket, see get_status
+        self.status_cache = {}
+        self.status_lock = threading.Lock()
+        # one lock per magnet socket, the watchdog thread shares the sockets with the driver
+        self.socket_locks = {}
+        # ramp table last uploaded to every magnet socket, see set_ramp_table
+        self.ramp_tables = {}
+        # coil constant (field per ampere, in the field units of the magnet) of every magnet socket, see get_status
+        self.coil_constants = {}
+        # number of snapshots since the current was last measured, for every magnet socket
+        self.status_reads = {}
+        self.current_check_interval = 10
+        # background watchdog, see start_watchdog
+        self.watchdog_thread = None
+        self.watchdog_stop = threading.Event()
+        self.watchdog_interval = 0.5
+        # telemetry recorder (see start_telemetry), None if telemetry is not recorded
+        self.telemetry = None
+        self.telemetry_time = 0.0
+        # arc sweep in progress (see start_arc_sweep), None if the magnet is not sweeping
+        self.arc_sweep = None
+        # switch heater and persistent mode transitions in progress for every magnet socket, see start_transition
+        self.transitions = {}
+        # result of the last finished transition of every magnet socket, True if it succeeded
+        self.transition_results = {}
+        # sockets of the magnets that could not be reached stay None, the reason is kept for the error messages
+        self.CONNECTED_MAGNETS = {"x": False, "y": False, "z": False}
+        self.connection_errors = {}
+        # all three magnets are connected at the same time, so startup takes one connect timeout and not three
+        addresses = self.magnet_addresses()
+        timeout = self.get_connect_timeout()
+        futures = {axis: self.poll_pool.submit(self.connect_magnet, address, timeout)
+                   for axis, address in addresses.items()}
+        for axis, future in futures.items():
+            try:
+                magnet_socket = future.result()
+            except OSError as e:
+                magnet_socket = None
+                self.connection_errors[axis] = "{}:{} ({})".format(addresses[axis][0], addresses[axis][1], e)
+                logging.error(__name__ + ": {} magnet is not connected: {}".format(axis, self.connection_errors[axis]))
+            else:
+                self.CONNECTED_MAGNETS[axis] = True
+            setattr(self, axis + "_magnet_socket", magnet_socket)
+
+        if not any(self.CONNECTED_MAGNETS.values()):
+            self.poll_pool.shutdown()
+            raise ConnectionError("None of the magnets is reachable: " + ", ".join(
+                "{} {}".format(axis, error) for axis, error in sorted(self.connection_errors.items())))
+        if self.connection_errors:
+            self.reportStatus("Not connected: " + ", ".join(sorted(self.connection_errors)))
+
+        for axis in ("x", "y", "z"):
+            if self.CONNECTED_MAGNETS[axis]:
+                self.read_coil_constant(getattr(self, axis + "_magnet_socket"))
+                self.set_ramp_table(getattr(self, axis + "_magnet_socket"), self.getValue(axis + "_rampTable"),
+                                    self.field_ratings[axis])
 
         return self.CONNECTED_MAGNETS
 
@@ -96,9 +167,13 @@ class Driver(LabberDriver):
 
         :return: NoneType
         """
-        self.x_magnet_socket.close()
-        self.y_magnet_socket.close()
-        self.z_magnet_socket.close()
+        self.stop_watchdog()
+        self.stop_telemetry()
+        self.poll_pool.shutdown()
+        for axis in ("x", "y", "z"):
+            magnet_socket = getattr(self, axis + "_magnet_socket", None)
+            if magnet_socket is not None:
+                magnet_socket.close()
         return
 
     def performSetValue(self, quant, value, sweepRate=0.0, options={}):
@@ -130,19 +205,24 @@ class Driver(LabberDriver):
         if quant.name[0] == "x":
             # field rating is required when setting a ramp rate ("CONF:RAMP:RATE:FIELD 1, value, fieldrating")
             fieldrating = 1.01  # field rating is a maximum value that field can go to and its different for all magnets
-            socket = self.x_magnet_socket
+            socket = self.magnet_socket("x")
         elif quant.name[0] == "y":
             fieldrating = 0.98
-            socket = self.y_magnet_socket
+            socket = self.magnet_socket("y")
         elif quant.name[0] == "z":
             fieldrating = 5.99
-            socket = self.z_magnet_socket
+            socket = self.magnet_socket("z")
         else:
             # Some quantities include all 3 magnets, those should not start with letters x,y or z.
             # In cases when a quantity name does not start with one of the letters mentioned above, we directly call
             # the method that handles setting that value
             # Those quantities do not require a magnet socket because they usually interact with all 3 magnets
-            if quant.name == "radius":
+            if quant.name in self.vector_quantities:
+                self.magnet_sockets()
+            self.wait_for_transitions()
+            if quant.name in ("theta", "phi") and sweepRate != 0:
+                return self.start_arc_sweep(quant.name, value, sweepRate)
+            elif quant.name == "radius":
                 return self.set_radius(value)
             elif quant.name == "theta":
                 return self.set_theta(value)
@@ -154,16 +234,45 @@ class Driver(LabberDriver):
                 return self.set_constant_theta(value)
             elif quant.name == "constant_phi":
                 return self.set_constant_phi(value)
+            elif quant.name == "status_cache_time":
+                return value
+            elif quant.name == "watchdog":
+                if value:
+                    self.start_watchdog()
+                else:
+                    self.stop_watchdog()
+                return value
+            elif quant.name == "watchdog_interval":
+                self.watchdog_interval = value
+                return value
+            elif quant.name == "current_check_interval":
+                self.current_check_interval = int(value)
+                return value
+            elif quant.name == "telemetry":
+                if value:
+                    self.start_telemetry()
+                else:
+                    self.stop_telemetry()
+                return value
+            elif quant.name == "telemetry_directory":
+                return value
             else:
-                pass
+                # settings that only Labber uses (ex. coordinate_system), there is no magnet to talk to
+                return value
+
+        # Switch heater and persistent mode changes of all magnets run at the same time, any other change of a magnet
+        # has to wait until its transition is finished
+        if quant.name[2:] not in ("pSwitch", "persistent"):
+            self.wait_for_transitions([socket])
 
         # After deciding what magnet to communicate to, we call the method that does it
         if quant.name[2:] == "pSwitch":
-            self.set_p_switch(socket, value)
+            self.start_transition(socket, self.p_switch_transition(socket, value))
         elif quant.name[2:] == "current":
             self.set_current(socket, value)
         elif quant.name[2:] == "field":
             self.set_field(socket, value)
+            self.wait_for_ramp(socket)
         elif quant.name[2:] == "units":
             self.set_units(socket, value)
         elif quant.name[2:] == "setPoint":
@@ -172,10 +281,13 @@ class Driver(LabberDriver):
             if fieldrating is None:
                 fieldrating = 0.98
             self.set_ramp_rate(socket, value, fieldrating)
+        elif quant.name[2:] == "rampTable":
+            self.set_ramp_table(socket, value, fieldrating)
         elif quant.name[2:] == "quench":
             self.reset_quench(socket)
         elif quant.name[2:] == "persistent":
-            self.set_persistent(socket, value)
+            # finishes in the background, a failed transition is reported in the status (see finish_transition)
+            self.start_transition(socket, self.persistent_transition(socket, value))
         elif quant.name[2:] == "ramp":
             if self.is_ready_to_ramp(socket):
                 self.start_ramping(socket)
@@ -186,8 +298,39 @@ class Driver(LabberDriver):
         else:
             return
 
+        if self.isFinalCall(options):
+            self.wait_for_transitions()
         return value
 
+    def checkIfSweeping(self, quant, options={}):
+        """
+        Called by Labber while a quantity is being swept. Arc sweeps are driven from here: every call checks the field
+        and sends the next set point of the arc when the magnets get close to the current one.
+
+        :param quant: Quantity that is being swept
+        :type quant:
+        :param options:
+        :return: True if the sweep is still running
+        :rtype: bool
+        """
+        if self.arc_sweep is None or quant.name != self.arc_sweep["quant"]:
+            return False
+        return self.advance_arc_sweep()
+
+    def performStopSweep(self, quant, options={}):
+        """
+        Called by Labber when a sweep is stopped before reaching the end. All magnets are paused at the current field.
+
+        :param quant: Quantity that is being swept
+        :type quant:
+        :param options:
+        :return: NoneType
+        """
+        if self.arc_sweep is not None:
+            self.arc_sweep = None
+            for magnet_socket in self.magnet_sockets():
+                self.pause_ramp(magnet_socket)
+
     def performGetValue(self, quant, options={}):
         """
         This method is called when we are trying to get the value of any of the isntruments quantities. Depending on the
@@ -206,19 +349,25 @@ class Driver(LabberDriver):
         :return: any: a response from the instrument after sending a command to read the specified parameter
         :rtype:
         """
+        # connection status is known without talking to the magnet, it is also available for missing magnets
+        if quant.name[1:] == "_connected":
+            return self.CONNECTED_MAGNETS[quant.name[0]]
+
         # naming convention for quantities is magnet_quantity (ex. x_current, y_field, z_ramp_rate, ...)
         # from that we can extract what magnet we need to communicate with
         if quant.name[0] == "x":
-            socket = self.x_magnet_socket
+            socket = self.magnet_socket("x")
         elif quant.name[0] == "y":
-            socket = self.y_magnet_socket
+            socket = self.magnet_socket("y")
         elif quant.name[0] == "z":
-            socket = self.z_magnet_socket
+            socket = self.magnet_socket("z")
         else:
             # Some quantities include all 3 magnets, those should not start with letters x,y or z.
             # In cases when a quantity name does not start with one of the letters mentioned above, we directly call
             # the method that handles getting that value
             # Those quantities do not require a magnet socket because they usually interact with all 3 magnets
+            if quant.name in self.vector_quantities:
+                self.magnet_sockets()
             if quant.name == "radius":
                 return self.get_radius()
             elif quant.name == "theta":
@@ -231,6 +380,13 @@ class Driver(LabberDriver):
                 return self.get_constant_theta()
             elif quant.name == "constant_phi":
                 return self.get_constant_phi()
+            elif quant.name in ("status_cache_time", "watchdog_interval", "telemetry_directory",
+                                "current_check_interval"):
+                return self.getValue(quant.name)
+            elif quant.name == "telemetry":
+                return self.telemetry is not None
+            elif quant.name == "watchdog":
+                return self.watchdog_thread is not None
             else:
                 pass
 
@@ -247,6 +403,8 @@ class Driver(LabberDriver):
             return self.get_set_point(socket)
         elif quant.name[2:] == "rampRate":
             return self.get_ramp_rate(socket)
+        elif quant.name[2:] == "rampTable":
+            return self.getValue(quant.name)
         elif quant.name[2:] == "rampState":
             return self. get_ramp_state(socket)
         elif quant.name[2:] == "persistent":
@@ -263,10 +421,86 @@ class Driver(LabberDriver):
     # ##### INSTRUMENT COMMUNICATION #####
     # ####################################
     """
-    def _send(self, magnet_socket, command):  # ##TODO: check for timeout and throw exception
+    def magnet_addresses(self):
+        """
+        Addresses of the magnets. The address in the Labber address config can list them as "x=IP[:PORT], y=IP[:PORT],
+        z=IP[:PORT]" (port 7180 if it is left out), magnets that are not listed use the addresses at the top of this
+        class.
+
+        :return: (IP, PORT) of the x, y and z magnet
+        :rtype: dict
+        """
+        addresses = {axis: (getattr(self, axis + "_magnet_IP"), getattr(self, axis + "_magnet_PORT"))
+                     for axis in ("x", "y", "z")}
+        config = getattr(getattr(self, "comCfg", None), "address", "") or ""
+        for entry in config.replace(";", ",").split(","):
+            if not entry.strip():
+                continue
+            axis, _, address = entry.partition("=")
+            axis = axis.strip().lower()
+            if axis not in addresses or not address.strip():
+                raise ValueError("Magnet address has to be written as 'x=IP[:PORT], y=IP[:PORT], z=IP[:PORT]', got: "
+                                 + entry)
+            ip, _, port = address.strip().partition(":")
+            addresses[axis] = (ip, int(port) if port else 7180)
+        return addresses
+
+    def get_connect_timeout(self):
+        """
+        :return: Timeout (seconds) from the Labber address config, connect_timeout if it is not set
+        :rtype: float
+        """
+        timeout = getattr(getattr(self, "comCfg", None), "timeout", None)
+        return float(timeout) if timeout else self.connect_timeout
+
+    def connect_magnet(self, address, timeout):
+        """
+        Open the socket of one magnet and throw away its welcome message.
+
+        :param address: (IP, PORT) of the magnet
+        :type address: tuple
+        :param timeout: Time (seconds) to wait for the magnet to accept the connection
+        :type timeout: float
+        :return: Connected socket
+        :rtype: socket.socket
+        """
+        magnet_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        magnet_socket.settimeout(timeout)
+        try:
+            magnet_socket.connect(address)
+            # welcome message is not a reply to any query
+            self._flush(magnet_socket)
+        except OSError:
+            magnet_socket.close()
+            raise
+        return magnet_socket
+
+    def magnet_socket(self, axis):
+        """
+        :param axis: x, y or z
+        :type axis: str
+        :return: Socket of the magnet
+        :rtype: socket.socket
+        """
+        if not self.CONNECTED_MAGNETS[axis]:
+            raise ConnectionError("{} magnet is not connected: {}".format(
+                axis, self.connection_errors.get(axis, "driver is not open")))
+        return getattr(self, axis + "_magnet_socket")
+
+    def magnet_sockets(self):
+        """
+        Sockets of all 3 magnets, for the operations that need the whole vector magnet.
+
+        :return: Sockets of the x, y and z magnet
+        :rtype: tuple
+        """
+        return tuple(self.magnet_socket(axis) for axis in ("x", "y", "z"))
+
+    def _send(self, magnet_socket, command):
         """
-        Send a command to a magnet specified by its socket. After sending a command sleep for 0.6 seconds to give magnet
-        time to do the required action.
+        Send a command to a magnet specified by its socket. Commands are terminated by a line feed, the instrument
+        processes them in the order they arrive so there is no need to wait after sending. Any command that is not a
+        query can change the state of the magnet, so the cached status snapshot of that magnet is dropped.
 
         :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
                               directions is controled by a unique instrument and they have to be specified by
@@ -276,30 +510,64 @@ class Driver(LabberDriver):
         :type command: str
         :return: NoneType
         """
-        magnet_socket.sendall(bytes(command, "ASCII"))
-        time.sleep(0.8)  # ##Temporary solution for too fast computers
+        with self._lock(magnet_socket):
+            if any(not part.strip().endswith("?") for part in command.split(";")):
+                with self.status_lock:
+                    self.status_cache.pop(magnet_socket, None)
+            magnet_socket.sendall(bytes(command, "ASCII"))
         return
 
-    def _receive(self, magnet_socket):
+    def _lock(self, magnet_socket):
         """
-        Read the data from the instruments standard event buffer. When a command is sent to an instrument the response
-        is stored in the standard event buffer. In order to obtain  the result from the instrument we have to read this
-        buffer.
+        Lock that has to be held while communicating with a magnet, so a query and its reply are never interleaved
+        with the communication of another thread. It is reentrant, a query can be built from the other methods of the
+        transport.
+
+        :param magnet_socket: Specifies magnets socket.
+        :type magnet_socket: socket.socket
+        :return: Lock of the magnet socket
+        :rtype: threading.RLock
+        """
+        return self.socket_locks.setdefault(magnet_socket, threading.RLock())
+
+    def _receive(self, magnet_socket, timeout=None):
+        """
+        Read one reply from the instrument. Bytes are collected until the reply terminator arrives, anything received
+        after the terminator is kept for the next reply.
 
         :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
                               directions is controled by a unique instrument and they have to be specified by
                               their socket.
         :type magnet_socket: socket.socket
-        :return: Content of the instruments standard event buffer after sending the command
+        :param timeout: Maximum time to wait for the reply in seconds, reply_timeout if None
+        :type timeout: float
+        :return: Reply of the instrument without the terminator
         :rtype: str
         """
-        return magnet_socket.recv(self.BUFFSIZE)
-
-    def _ask(self, magnet_socket, command):
-        """
-        Send a command and instantly read a reply from the instrument. To be used when getting an instrument value.
-        First we send a command to query some instrument value, instrument replies by setting that value in the
-        standard event buffer. Then we read and return the value from the standard event buffer.
+        deadline = time.time() + (self.reply_timeout if timeout is None else timeout)
+        buffer = self.receive_buffers.get(magnet_socket, b"")
+        while self.TERMINATOR not in buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                # a late reply would be read as the reply to the next query, throw away everything that is left
+                self._flush(magnet_socket)
+                raise socket.timeout("Magnet power supply did not reply in time")
+            magnet_socket.settimeout(remaining)
+            try:
+                data = magnet_socket.recv(self.BUFFSIZE)
+            except socket.timeout:
+                continue
+            if not data:
+                raise ConnectionError("Magnet power supply closed the connection")
+            buffer += data
+
+        reply, self.receive_buffers[magnet_socket] = buffer.split(self.TERMINATOR, 1)
+        return reply.decode("ASCII")
+
+    def _ask(self, magnet_socket, command, timeout=None):
+        """
+        Send a command and read the reply from the instrument. To be used when getting an instrument value. The time it
+        takes is the network round trip plus the time instrument needs to answer.
 
         :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
                               directions is controled by a unique instrument and they have to be specified by
@@ -307,11 +575,75 @@ class Driver(LabberDriver):
         :type magnet_socket: socket.socket
         :param command: A command that we are sending to an instrument
         :type command: str
-        :return: Content of the instruments standard event buffer after sending the command
+        :param timeout: Maximum time to wait for the reply in seconds, reply_timeout if None
+        :type timeout: float
+        :return: Reply of the instrument without the terminator
         :rtype: str
         """
-        self._send(magnet_socket, command)
-        return self._receive(magnet_socket)
+        with self._lock(magnet_socket):
+            self._send(magnet_socket, command)
+            return self._receive(magnet_socket, timeout)
+
+    def _send_many(self, magnet_socket, commands):
+        """
+        Send several commands in one line. The instrument accepts semicolon separated commands and executes them in
+        the given order, so a sequence like PAUSE;CONF:FIELD:TARG x;RAMP costs one network transfer.
+
+        :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
+                              directions is controled by a unique instrument and they have to be specified by
+                              their socket.
+        :type magnet_socket: socket.socket
+        :param commands: Commands without terminators (ex. ["PAUSE", "RAMP"])
+        :type commands: list
+        :return: NoneType
+        """
+        self._send(magnet_socket, ";".join(commands) + "\n")
+        return
+
+    def _ask_many(self, magnet_socket, queries, timeout=None):
+        """
+        Send several queries in one line and return their replies in the same order. Replies are split on both
+        semicolons and terminators, so it does not matter if the instrument answers in one line or in one line per
+        query.
+
+        :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
+                              directions is controled by a unique instrument and they have to be specified by
+                              their socket.
+        :type magnet_socket: socket.socket
+        :param queries: Queries without terminators (ex. ["STATE?", "FIELD:MAG?"])
+        :type queries: list
+        :param timeout: Maximum time to wait for each reply line in seconds, reply_timeout if None
+        :type timeout: float
+        :return: Replies of the instrument, one for every query
+        :rtype: list
+        """
+        replies = []
+        with self._lock(magnet_socket):
+            self._send_many(magnet_socket, queries)
+            while len(replies) < len(queries):
+                replies += self._receive(magnet_socket, timeout).split(";")
+        return replies
+
+    def _flush(self, magnet_socket):
+        """
+        Read and throw away everything the instrument sends until it stays silent for banner_timeout seconds.
+
+        :param magnet_socket: Specifies magnets socket.
+        :type magnet_socket: socket.socket
+        :return: Everything that was thrown away
+        :rtype: bytes
+        """
+        data = self.receive_buffers.pop(magnet_socket, b"")
+        magnet_socket.settimeout(self.banner_timeout)
+        try:
+            while True:
+                chunk = magnet_socket.recv(self.BUFFSIZE)
+                if not chunk:
+                    break
+                data += chunk
+        except socket.timeout:
+            pass
+        return data
 
     """
     # ####################################
@@ -411,6 +743,139 @@ class Driver(LabberDriver):
     # ####################################
     """
 
+    def next_poll_interval(self, remaining_time):
+        """
+        Time to sleep before the next status poll. Far from the next event the driver sleeps through most of the
+        predicted time, close to it polls get dense.
+
+        :param remaining_time: Predicted time until the target or a safety threshold is reached (seconds)
+        :type remaining_time: float
+        :return: Time to sleep in seconds
+        :rtype: float
+        """
+        return min(max(remaining_time * self.poll_fraction, self.min_poll_interval), self.max_poll_interval)
+
+    def wait_for_ramp(self, magnet_socket):
+        """
+        Wait until the magnet stops ramping (to the set point or to zero). Poll interval is calculated from the
+        remaining distance and the slowest ramp rate on the way, so a long ramp needs only a few status queries and the wait ends as soon
+        as the supply reports it reached the target.
+
+        :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
+                              directions is controlled by a unique instrument and they have to be specified by
+                              their socket.
+        :type magnet_socket: socket.socket
+        :return: True if the magnet is holding at the set point or at zero, False otherwise
+        :rtype: bool
+        """
+        while True:
+            if self.isStopped():
+                self.pause_ramp(magnet_socket)
+                return False
+            status = self.get_status(magnet_socket, max_age=0)
+            if status["rampState"] == 0:
+                target = status["setPoint"]
+            elif status["rampState"] == 5:
+                target = 0.0
+            else:
+                return status["rampState"] in (1, 7)
+            ramp_rate = self.get_slowest_ramp_rate(magnet_socket, status["field"], target)
+            time.sleep(self.next_poll_interval(abs(target - status["field"]) / ramp_rate))
+
+    def get_status(self, magnet_socket, max_age=None):
+        """
+        Get the status snapshot of a magnet: ramp state, field, set point, persistent flag, quench flag and current.
+        All queries are sent in one line and the replies are parsed by position, so the snapshot costs one round trip.
+        Snapshot is cached for status_cache_time seconds (or until the next watchdog poll if the watchdog is running),
+        getters of the individual values read from it.
+
+        Current is the field divided by the cached coil constant. Every current_check_interval-th snapshot (every
+        snapshot if it is 0) measures it with CURR:MAG? instead, and reads the coil constant again if the two
+        disagree.
+
+        :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
+                              directions is controlled by a unique instrument and they have to be specified by
+                              their socket.
+        :type magnet_socket: socket.socket
+        :param max_age: Oldest snapshot (seconds) that can be returned from the cache, status_cache_time if None
+        :type max_age: float
+        :return: Dictionary with keys time, rampState, field, setPoint, persistent, quench and current
+        :rtype: dict
+        """
+        if max_age is None:
+            max_age = self.getValue("status_cache_time")
+            if self.watchdog_thread is not None:
+                max_age = max(max_age, 2 * self.watchdog_interval)
+        with self.status_lock:
+            status = self.status_cache.get(magnet_socket)
+        if status is not None and time.time() - status["time"] < max_age:
+            return status
+
+        # snapshot is stored before the socket is released, so it can not overwrite the drop done by a later command
+        with self._lock(magnet_socket):
+            reads = self.status_reads.get(magnet_socket, 0) + 1
+            measure = self.current_check_interval <= 0 or reads >= self.current_check_interval or \
+                magnet_socket not in self.coil_constants
+            replies = self._ask_many(magnet_socket, self.status_queries + (["CURR:MAG?"] if measure else []))
+            state, field, set_point, persistent, quench = replies[:5]
+            if measure:
+                current = float(replies[5])
+                self.status_reads[magnet_socket] = 0
+                self.check_coil_constant(magnet_socket, float(field), current)
+            else:
+                current = float(field) / self.coil_constants[magnet_socket]
+                self.status_reads[magnet_socket] = reads
+            status = {"time": time.time(),
+                      "rampState": int(state) - 1,
+                      "field": float(field),
+                      "setPoint": float(set_point),
+                      "persistent": int(persistent) == 1,
+                      "quench": int(quench) == 1,
+                      "current": current}
+            with self.status_lock:
+                self.status_cache[magnet_socket] = status
+        return status
+
+    def read_coil_constant(self, magnet_socket):
+        """
+        Read the coil constant of a magnet and cache it. Coil constant is given in the field units selected on the
+        instrument, so it has to be read again whenever the units change.
+
+        :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
+                              directions is controlled by a unique instrument and they have to be specified by
+                              their socket.
+        :type magnet_socket: socket.socket
+        :return: Coil constant (kG/A or T/A)
+        :rtype: float
+        """
+        coil_constant = float(self._ask(magnet_socket, "COIL?\n"))
+        self.coil_constants[magnet_socket] = coil_constant
+        return coil_constant
+
+    def check_coil_constant(self, magnet_socket, field, current):
+        """
+        Compare a measured current with the one derived from the field, and read the coil constant again if they
+        disagree (someone changed it on the front panel).
+
+        :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
+                              directions is controlled by a unique instrument and they have to be specified by
+                              their socket.
+        :type magnet_socket: socket.socket
+        :param field: Measured field
+        :type field: float
+        :param current: Measured current (A)
+        :type current: float
+        :return: NoneType
+        """
+        coil_constant = self.coil_constants.get(magnet_socket)
+        if coil_constant is not None and \
+                abs(field / coil_constant - current) <= self.coil_constant_tolerance * abs(current) + 1e-3:
+            return
+        if coil_constant is not None:
+            logging.warning(__name__ + ": Current derived from the field ({}) does not match the measured current "
+                                       "({}), reading the coil constant again".format(field / coil_constant, current))
+        self.read_coil_constant(magnet_socket)
+
     def get_ramp_state(self, magnet_socket):
         """
         Get the current state of the ramp.
@@ -420,7 +885,7 @@ class Driver(LabberDriver):
                                     their socket.
         :return: Integer:
         """
-        return int(self._ask(magnet_socket, "STATE?\n")) - 1
+        return self.get_status(magnet_socket)["rampState"]
 
     def get_p_switch(self, magnet_socket):
         """
@@ -436,6 +901,7 @@ class Driver(LabberDriver):
     def set_p_switch(self, magnet_socket, value):
         """
         Set the value of pSwitch of a magnet specified by :magnet_socket: to a value specified by parameter :value:.
+        Returns when the switch is heated or cooled.
 
         :param magnet_socket: Reference to one of 3 sockets (x, y or z)
         :type magnet_socket: socket.socket
@@ -444,18 +910,24 @@ class Driver(LabberDriver):
 
         :return: NoneType
         """
-        if value:
-            self._send(magnet_socket, "PS 1\n")
-            time.sleep(0.5)
-            while self.get_ramp_state(magnet_socket) == 8:
-                time.sleep(0.3)
-            return
-        else:
-            self._send(magnet_socket, "PS 0\n")
-            time.sleep(0.5)
-            while self.get_ramp_state(magnet_socket) == 9:
-                time.sleep(0.3)
-            return
+        self.start_transition(magnet_socket, self.p_switch_transition(magnet_socket, value))
+        self.wait_for_transitions([magnet_socket])
+        return
+
+    def p_switch_transition(self, magnet_socket, value):
+        """
+        Transition of the switch heater (see start_transition). Sends the command and waits until the supply is done
+        heating or cooling the switch.
+
+        :param magnet_socket: Reference to one of 3 sockets (x, y or z)
+        :type magnet_socket: socket.socket
+        :param value: Value to set the pSwitch to, 1 for ON, 0 for OFF
+        :type value: bool
+        :return: Generator of the transition steps, returns True
+        """
+        self._send(magnet_socket, "PS {}\n".format(1 if value else 0))
+        yield lambda status: status["rampState"] not in (8, 9)
+        return True
 
     def get_ramp_rate(self, magnet_socket):
         """
@@ -467,11 +939,12 @@ class Driver(LabberDriver):
 
         :return: Float: Current value of the ramp rate. Represents how fast is the value of field changing
         """
-        return float(str(self._ask(magnet_socket, "RAMP:RATE:FIELD:1?\n")).split(",", 1)[0][2:])
+        return float(self._ask(magnet_socket, "RAMP:RATE:FIELD:1?\n").split(",", 1)[0])
 
     def set_ramp_rate(self, magnet_socket, value, magnet_fieldrating):
         """
-
+        Set the ramp rate of segment 1. If a multi segment ramp table is in use, the upper field of segment 1 and the
+        other segments are kept.
 
         :param magnet_socket: Socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
                                     directions is controled by a unique instrument and they have to be specified by
@@ -483,9 +956,122 @@ class Driver(LabberDriver):
 
         :return: NoneType
         """
-        self._send(magnet_socket, "CONF:RAMP:RATE:FIELD 1, {}, {}\n".format(str(value), str(magnet_fieldrating)))
+        table = self.get_ramp_table(magnet_socket)
+        if len(table) > 1:
+            # multi segment ramp table: only the rate of segment 1 changes, its upper field stays as uploaded so the
+            # segments remain ordered
+            upper = table[0][1]
+            self._send(magnet_socket, "CONF:RAMP:RATE:FIELD 1, {}, {}\n".format(str(value), str(upper)))
+            self.ramp_tables[magnet_socket] = [(float(value), upper)] + table[1:]
+        else:
+            self._send(magnet_socket, "CONF:RAMP:RATE:FIELD 1, {}, {}\n".format(str(value), str(magnet_fieldrating)))
+            self.ramp_tables[magnet_socket] = [(float(value), float(magnet_fieldrating))]
         return
 
+    def parse_ramp_table(self, table, magnet_fieldrating):
+        """
+        Parse a ramp table written as "rate, upper field; rate, upper field; ...". Segments have to be ordered by their
+        upper field, the last one can not go above the field rating of the magnet.
+
+        :param table: Ramp table as entered in the .ini quantity
+        :type table: str
+        :param magnet_fieldrating: Maximum field of the magnet
+        :type magnet_fieldrating: float
+        :return: List of (rate, upper field) segments, empty if the table is empty
+        :rtype: list
+        """
+        segments = []
+        for entry in table.split(";"):
+            if entry.strip():
+                rate, upper = [float(number) for number in entry.split(",")]
+                segments.append((rate, upper))
+        bounds = [upper for rate, upper in segments]
+        if any(rate <= 0 for rate, upper in segments) or bounds != sorted(bounds) or \
+                (bounds and (bounds[0] <= 0 or bounds[-1] > magnet_fieldrating)):
+            raise ValueError("Ramp table has to be 'rate, upper field; ...' with positive rates and increasing upper "
+                             "fields up to {} T".format(magnet_fieldrating))
+        return segments
+
+    def set_ramp_table(self, magnet_socket, table, magnet_fieldrating):
+        """
+        Upload a multi segment ramp table: every segment ramps with its own rate up to its upper field, so ramps
+        through low field can run faster than the rate that is safe close to the field rating. Table is sent in one
+        line, and only if it differs from the table uploaded last. Empty table leaves the instrument settings as they
+        are.
+
+        :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
+                              directions is controlled by a unique instrument and they have to be specified by
+                              their socket.
+        :type magnet_socket: socket.socket
+        :param table: Ramp table, "rate, upper field; rate, upper field; ..." (T/s, T)
+        :type table: str
+        :param magnet_fieldrating: Maximum field of the magnet
+        :type magnet_fieldrating: float
+        :return: NoneType
+        """
+        segments = self.parse_ramp_table(table, magnet_fieldrating)
+        if not segments or self.ramp_tables.get(magnet_socket) == segments:
+            return
+        commands = ["CONF:RAMP:RATE:SEG {}".format(len(segments))]
+        commands += ["CONF:RAMP:RATE:FIELD {},{},{}".format(segment + 1, rate, upper)
+                     for segment, (rate, upper) in enumerate(segments)]
+        self._send_many(magnet_socket, commands)
+        self.ramp_tables[magnet_socket] = segments
+
+    def get_ramp_table(self, magnet_socket):
+        """
+        Get the ramp table of a magnet as a list of (rate, upper field) segments. The table uploaded last is used if
+        there is one, otherwise the table is read from the instrument (in one round trip after the number of segments)
+        and kept until the ramp rate or the table is changed.
+
+        :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
+                              directions is controlled by a unique instrument and they have to be specified by
+                              their socket.
+        :type magnet_socket: socket.socket
+        :return: List of (rate, upper field) segments
+        :rtype: list
+        """
+        if magnet_socket not in self.ramp_tables:
+            count = int(self._ask(magnet_socket, "RAMP:RATE:SEG?\n"))
+            replies = self._ask_many(magnet_socket, ["RAMP:RATE:FIELD:{}?".format(segment + 1)
+                                                     for segment in range(count)])
+            self.ramp_tables[magnet_socket] = [tuple(float(number) for number in reply.split(",")[:2])
+                                               for reply in replies]
+        return self.ramp_tables[magnet_socket]
+
+    def get_slowest_ramp_rate(self, magnet_socket, start, target):
+        """
+        Slowest ramp rate of the magnet while its field goes from start to target. Every segment of the ramp table that
+        the move passes through counts, so predictions and safety checks that use this rate never assume the magnet
+        is faster than it is.
+
+        :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
+                              directions is controlled by a unique instrument and they have to be specified by
+                              their socket.
+        :type magnet_socket: socket.socket
+        :param start: Field at the start of the move
+        :type start: float
+        :param target: Field at the end of the move
+        :type target: float
+        :return: Ramp rate in field units per second
+        :rtype: float
+        """
+        # segments are defined by the magnitude of the field, a move through zero passes through all of them up to
+        # the larger end
+        high = max(abs(start), abs(target))
+        low = 0.0 if start * target <= 0 else min(abs(start), abs(target))
+        rates = []
+        lower = 0.0
+        for rate, upper in self.get_ramp_table(magnet_socket):
+            # segment covers the fields above lower up to upper
+            if upper >= low and (lower < high or not rates):
+                rates.append(rate)
+            lower = upper
+        # above the last segment the instrument keeps using its rate
+        if not rates or high > lower:
+            rates.append(self.get_ramp_table(magnet_socket)[-1][0])
+        return min(rates)
+
     def get_field(self, magnet_socket):
         """
         Get the current value of the field
@@ -496,8 +1082,7 @@ class Driver(LabberDriver):
 
         :return: Float: Current value of the magnetic field.
         """
-        self.get_ramp_state(magnet_socket)
-        return float(self._ask(magnet_socket, "FIELD:MAG?\n"))
+        return self.get_status(magnet_socket)["field"]
 
     def set_field(self, magnet_socket, value):
         """
@@ -513,9 +1098,7 @@ class Driver(LabberDriver):
 
         :return: NoneType
         """
-        self.pause_ramp(magnet_socket)
-        self._send(magnet_socket, "CONF:FIELD:TARG {} ;".format(float(value)))
-        self.start_ramping(magnet_socket)
+        self._send_many(magnet_socket, ["PAUSE", "CONF:FIELD:TARG {}".format(float(value)), "RAMP"])
         return True
 
     def set_set_point(self, magnet_socket, value):
@@ -530,8 +1113,7 @@ class Driver(LabberDriver):
         :type value: float
         :return: NoneType
         """
-        self.pause_ramp(magnet_socket)
-        self._send(magnet_socket, "CONF:FIELD:TARG {} ;".format(float(value)))
+        self._send_many(magnet_socket, ["PAUSE", "CONF:FIELD:TARG {}".format(float(value))])
         return
 
     def get_set_point(self, magnet_socket):
@@ -546,8 +1128,7 @@ class Driver(LabberDriver):
         :return: Current set point to which we are trying to ramp the field to.
         :rtype: float
         """
-        self.get_ramp_state(magnet_socket)
-        return float(self._ask(magnet_socket, "FIELD:TARG?\n"))
+        return self.get_status(magnet_socket)["setPoint"]
 
     def get_current(self, magnet_socket):
         """
@@ -560,7 +1141,7 @@ class Driver(LabberDriver):
         :return: Value of the current on the instrument.
         :rtype: float
         """
-        return float(self._ask(magnet_socket, "CURR:MAG?\n"))
+        return self.get_status(magnet_socket)["current"]
 
     def set_current(self, magnet_socket, value):
         """
@@ -575,9 +1156,7 @@ class Driver(LabberDriver):
         :type value: float
         :return: NoneType
         """
-        self.pause_ramp(magnet_socket)
-        self._send(magnet_socket, "CONF:CURR:TARG {} ;".format(float(value)))
-        self.start_ramping(magnet_socket)
+        self._send_many(magnet_socket, ["PAUSE", "CONF:CURR:TARG {}".format(float(value)), "RAMP"])
         return
 
     def get_units(self, magnet_socket):
@@ -605,7 +1184,9 @@ class Driver(LabberDriver):
         :type value: int
         :return: NoneType
         """
-        self._send(magnet_socket, "CONF:FIELD:UNITS {}".format(value))
+        self._send(magnet_socket, "CONF:FIELD:UNITS {}\n".format(value))
+        # coil constant is given in the field units
+        self.read_coil_constant(magnet_socket)
         return
 
     def get_quench(self, magnet_socket):
@@ -619,7 +1200,7 @@ class Driver(LabberDriver):
         :return: True if quenching, False if not
         :rtype: bool
         """
-        return int(self._ask(magnet_socket, "QU?\n")) == 1
+        return self.get_status(magnet_socket)["quench"]
 
     def reset_quench(self, magnet_socket):
         """
@@ -644,11 +1225,12 @@ class Driver(LabberDriver):
         :return: True if in persistent mode, False otherwise
         :rtype: bool
         """
-        return int(self._ask(magnet_socket, "PERS?\n")) == 1
+        return self.get_status(magnet_socket)["persistent"]
 
     def set_persistent(self, magnet_socket, value):
         """
-        Method that puts the instrument in or out of persistent mode.
+        Method that puts the instrument in or out of persistent mode. Returns when the transition is finished. Setting
+        the persistent quantity from Labber does not wait, it only starts the transition (see performSetValue).
 
         :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
                               directions is controlled by a unique instrument and they have to be specified by
@@ -656,45 +1238,129 @@ class Driver(LabberDriver):
         :type magnet_socket: socket.socket
         :param value: True if we want the instrument in persistent mode, otherwise False
         :type value: bool
-        :return: True if instrument is in persistent mode at the end of this method, otherwise False
+        :return: True if the instrument is in the requested mode at the end of this method, otherwise False
         :rtype: bool
         """
+        self.start_transition(magnet_socket, self.persistent_transition(magnet_socket, value))
+        self.wait_for_transitions([magnet_socket])
+        return self.transition_results.pop(magnet_socket, False)
+
+    def persistent_transition(self, magnet_socket, value):
+        """
+        Transition in or out of persistent mode (see start_transition). Into persistent mode: cool the switch and ramp
+        the leads to zero. Out of persistent mode: ramp the leads to the field of the magnet and heat the switch.
+
+        :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
+                              directions is controlled by a unique instrument and they have to be specified by
+                              their socket.
+        :type magnet_socket: socket.socket
+        :param value: True if we want the instrument in persistent mode, otherwise False
+        :type value: bool
+        :return: Generator of the transition steps, returns True if the instrument ends in the requested mode
+        """
         if value == 1:
             if self.get_persistent(magnet_socket):
                 return True
-            else:
-                temp = self.get_ramp_state(magnet_socket)
-                if not (temp == 1 or temp == 2):
-                    logging.error(__name__ + ': setting persistent mode failed, because of magnet status' + str(temp))
-                    return False
-                else:
-                    self.set_p_switch(magnet_socket, False)
-                    self.ramp_to_zero(magnet_socket)
-                    time.sleep(0.5)
-                    while self.get_ramp_state(magnet_socket) == 5:
-                        time.sleep(0.3)
-                    time.sleep(2.0)
-                    if self.get_persistent(magnet_socket) and (self.get_ramp_state(magnet_socket) == 7):
-                        return True
-                    else:
-                        logging.error(__name__ + ': Setting persistent mode failed, magnet status is ' +
-                                      str(self.get_ramp_state(magnet_socket)))
-                        return False
+            temp = self.get_ramp_state(magnet_socket)
+            if not (temp == 1 or temp == 2):
+                logging.error(__name__ + ': setting persistent mode failed, because of magnet status' + str(temp))
+                return False
+            yield from self.p_switch_transition(magnet_socket, False)
+            self.ramp_to_zero(magnet_socket)
+            status = yield lambda status: status["rampState"] != 5
+            if not (status["persistent"] and status["rampState"] == 7):
+                logging.error(__name__ + ': Setting persistent mode failed, magnet status is ' +
+                              str(status["rampState"]))
+                return False
+            return True
         else:
             if not self.get_persistent(magnet_socket):
                 return True
-            else:
-                temp = self.get_ramp_state(magnet_socket)
-                if not (temp == 1 or temp == 2 or temp == 7):
-                    logging.error(__name__ + ': setting driven mode failed, because of magnet status ' + str(temp))
-                    return False
-                else:
-                    if self.set_field(magnet_socket, self.get_field(magnet_socket)):
-                        self.set_p_switch(magnet_socket, True)
-                        return True
-                    else:
-                        logging.error(__name__ + ': setting driven mode failed, magnet cannot ramp to specified value')
-                        return False
+            temp = self.get_ramp_state(magnet_socket)
+            if not (temp == 1 or temp == 2 or temp == 7):
+                logging.error(__name__ + ': setting driven mode failed, because of magnet status ' + str(temp))
+                return False
+            self.set_field(magnet_socket, self.get_field(magnet_socket))
+            status = yield lambda status: status["rampState"] != 0
+            if status["rampState"] != 1:
+                logging.error(__name__ + ': setting driven mode failed, magnet cannot ramp to specified value')
+                return False
+            return (yield from self.p_switch_transition(magnet_socket, True))
+
+    def start_transition(self, magnet_socket, transition):
+        """
+        Start a switch heater or persistent mode transition of a magnet without waiting for it. A transition is a
+        generator: it sends commands and yields a condition on the status snapshot of the magnet (see get_status),
+        which has to be met before the next step. The status that met the condition is sent back into the generator.
+        Transitions of different magnets are advanced together by advance_transitions. Generator returns True if the
+        transition succeeded, see finish_transition.
+
+        :param magnet_socket: Specifies magnets socket.
+        :type magnet_socket: socket.socket
+        :param transition: Generator of the transition steps
+        :type transition: generator
+        :return: NoneType
+        """
+        self.wait_for_transitions([magnet_socket])
+        self.transition_results.pop(magnet_socket, None)
+        try:
+            self.transitions[magnet_socket] = (transition, next(transition))
+        except StopIteration as e:
+            self.finish_transition(magnet_socket, e.value)
+
+    def finish_transition(self, magnet_socket, result):
+        """
+        Keep the result of a finished transition. Transitions started from Labber run in the background, so a failure
+        is also shown in the status of the instrument (details are in the log).
+
+        :param magnet_socket: Specifies magnets socket.
+        :type magnet_socket: socket.socket
+        :param result: True if the transition succeeded
+        :type result: bool
+        :return: NoneType
+        """
+        self.transition_results[magnet_socket] = bool(result)
+        if not result:
+            axes = [axis for axis in ("x", "y", "z") if getattr(self, axis + "_magnet_socket", None) is magnet_socket]
+            self.reportStatus("Switch heater or persistent mode transition of the {} magnet failed".format(
+                "".join(axes)))
+
+    def advance_transitions(self):
+        """
+        Poll all magnets with a transition in progress at the same time, and move each transition whose condition is
+        met to its next step.
+
+        :return: NoneType
+        """
+        sockets = list(self.transitions)
+        statuses = self.poll_pool.map(lambda magnet_socket: self.get_status(magnet_socket, max_age=0), sockets)
+        for magnet_socket, status in zip(sockets, statuses):
+            transition, condition = self.transitions[magnet_socket]
+            if condition(status):
+                try:
+                    self.transitions[magnet_socket] = (transition, transition.send(status))
+                except StopIteration as e:
+                    del self.transitions[magnet_socket]
+                    self.finish_transition(magnet_socket, e.value)
+
+    def wait_for_transitions(self, sockets=None):
+        """
+        Wait until the transitions of the given magnets are finished. Every transition finishes as soon as the supply
+        reports its last step is done.
+
+        :param sockets: Sockets of the magnets to wait for, all magnets if None
+        :type sockets: list
+        :return: NoneType
+        """
+        while any(magnet_socket in self.transitions for magnet_socket in (sockets or list(self.transitions))):
+            if self.isStopped():
+                for magnet_socket in list(self.transitions):
+                    self.finish_transition(magnet_socket, False)
+                self.transitions = {}
+                return
+            self.advance_transitions()
+            if any(magnet_socket in self.transitions for magnet_socket in (sockets or list(self.transitions))):
+                time.sleep(self.switch_poll_interval)
 
     def get_error(self, magnet_socket):
         """
@@ -715,6 +1381,154 @@ class Driver(LabberDriver):
     # ####################################
     """
 
+    def start_watchdog(self):
+        """
+        Start the background watchdog. It polls the status of all 3 magnets every watchdog_interval seconds, which
+        keeps the status snapshot fresh for the getters, and pauses all magnets if any of them quenches or the
+        combined field leaves combined_field_limit. Watchdog needs all 3 magnets, it is not started if any of them is
+        not connected.
+
+        :return: NoneType
+        """
+        if self.watchdog_thread is not None:
+            return
+        missing = [axis for axis in ("x", "y", "z") if not self.CONNECTED_MAGNETS[axis]]
+        if missing:
+            message = "Watchdog not started, magnets not connected: " + ", ".join(missing)
+            self.reportStatus(message)
+            raise ConnectionError(message)
+        self.watchdog_interval = self.getValue("watchdog_interval")
+        self.watchdog_stop.clear()
+        self.watchdog_thread = threading.Thread(target=self.watchdog_worker)
+        self.watchdog_thread.daemon = True
+        self.watchdog_thread.start()
+
+    def stop_watchdog(self):
+        """
+        Stop the background watchdog and wait for its thread to finish.
+
+        :return: NoneType
+        """
+        if self.watchdog_thread is None:
+            return
+        self.watchdog_stop.set()
+        self.watchdog_thread.join()
+        self.watchdog_thread = None
+
+    def watchdog_worker(self):
+        """
+        Loop of the watchdog thread. Magnets are paused while the problem lasts and any of them is still ramping, so
+        restarting a ramp without fixing the problem is stopped again. Errors are logged and the loop keeps running,
+        the thread only ends when the watchdog is stopped.
+
+        :return: NoneType
+        """
+        reported = False
+        while not self.watchdog_stop.wait(self.watchdog_interval):
+            try:
+                reported = self.watchdog_check(reported)
+            except (socket.timeout, OSError) as e:
+                logging.error(__name__ + ': Watchdog could not read the magnet status: ' + str(e))
+            except Exception as e:
+                logging.exception(__name__ + ': Watchdog check failed: ' + str(e))
+
+    def watchdog_check(self, reported):
+        """
+        One check of the watchdog: pause all magnets if any of them quenched or the combined field is outside
+        combined_field_limit while a magnet is ramping.
+
+        :param reported: True if the problem was already logged by an earlier check
+        :type reported: bool
+        :return: True if there is a problem and it was logged
+        :rtype: bool
+        """
+        timestamp, statuses = self.get_statuses(max_age=0)
+        radius = np.sqrt(sum(status["field"] ** 2 for status in statuses))
+        quench = any(status["quench"] for status in statuses)
+        if not (quench or radius > self.combined_field_limit):
+            return False
+        if any(status["rampState"] in (0, 5) for status in statuses):
+            for magnet_socket in self.magnet_sockets():
+                self.pause_ramp(magnet_socket)
+        if not reported:
+            logging.error(__name__ + ': Watchdog paused all magnets, quench: {}, combined field: {}'.format(
+                quench, radius))
+        return True
+
+    def poll_magnets(self, method):
+        """
+        Call a getter for all 3 magnets at the same time. Each magnet has its own socket, so the queries run in
+        parallel and the whole call takes as long as the slowest supply instead of the sum of all three.
+
+        :param method: Getter that takes a magnet socket as its only argument (ex. self.get_field)
+        :type method: callable
+        :return: Results for x, y and z magnet
+        :rtype: list
+        """
+        futures = [self.poll_pool.submit(method, magnet_socket) for magnet_socket in self.magnet_sockets()]
+        return [future.result() for future in futures]
+
+    def get_statuses(self, max_age=None):
+        """
+        Get the status snapshots of all 3 magnets with concurrent queries. New snapshots are recorded by the telemetry
+        recorder if it is running.
+
+        :param max_age: Oldest status snapshot (seconds) that can be used, status_cache_time if None
+        :type max_age: float
+        :return: (timestamp, statuses): time in the middle of the exchange and the snapshots of the x, y and z magnet
+        :rtype: tuple
+        """
+        start = time.time()
+        statuses = self.poll_magnets(lambda magnet_socket: self.get_status(magnet_socket, max_age))
+        timestamp = (start + time.time()) / 2
+
+        telemetry = self.telemetry
+        if telemetry is not None:
+            newest = max(status["time"] for status in statuses)
+            if newest > self.telemetry_time:
+                self.telemetry_time = newest
+                telemetry.record(timestamp, statuses)
+        return timestamp, statuses
+
+    def get_fields(self, max_age=None):
+        """
+        Get the field of all 3 magnets with concurrent queries.
+
+        :param max_age: Oldest status snapshot (seconds) that can be used, status_cache_time if None
+        :type max_age: float
+        :return: (timestamp, x, y, z): time in the middle of the exchange and the value of the field in each direction
+        :rtype: tuple
+        """
+        timestamp, statuses = self.get_statuses(max_age)
+        x, y, z = [status["field"] for status in statuses]
+        return timestamp, x, y, z
+
+    def start_telemetry(self):
+        """
+        Start recording the status of all magnets (field, current, set point, ramp state and quench flag) every time
+        it is polled during ramps, by the watchdog or by the getters. Recording is done into a ring buffer and written
+        to .npy chunks in telemetry_directory (AMI430_telemetry in the home directory if it is empty) by a background
+        thread (see telemetry.TelemetryRecorder).
+
+        :return: NoneType
+        """
+        if self.telemetry is not None:
+            return
+        # by default outside the driver folder, so the recordings do not end up next to the driver code
+        directory = self.getValue("telemetry_directory") or os.path.join(os.path.expanduser("~"), "AMI430_telemetry")
+        self.telemetry = TelemetryRecorder(directory)
+
+    def stop_telemetry(self):
+        """
+        Stop recording the telemetry and write the remaining rows to disk.
+
+        :return: NoneType
+        """
+        if self.telemetry is None:
+            return
+        telemetry, self.telemetry = self.telemetry, None
+        telemetry.close()
+
     def spherical_to_cartesian(self, r, phi, theta):
         """
         Method that takes Spherical coordinates that represent the current field, and returns cartesian coordinates
@@ -766,8 +1580,7 @@ class Driver(LabberDriver):
         :return: Value of phi
         :rtype: float
         """
-        x = self.get_field(self.x_magnet_socket)
-        y = self.get_field(self.y_magnet_socket)
+        timestamp, x, y, z = self.get_fields()
 
         phi = np.rad2deg(np.arctan2(y, x))
 
@@ -825,9 +1638,7 @@ class Driver(LabberDriver):
         :return: Current value of the angle theta (between z axis and the radius)
         :rtype: float
         """
-        x = self.get_field(self.x_magnet_socket)
-        y = self.get_field(self.y_magnet_socket)
-        z = self.get_field(self.z_magnet_socket)
+        timestamp, x, y, z = self.get_fields()
 
         radius, phi, theta = self.cartesian_to_spherical(x, y, z)
 
@@ -884,9 +1695,7 @@ class Driver(LabberDriver):
         :return: Current REAL value of the radius
         :rtype: float
         """
-        x = self.get_field(self.x_magnet_socket)
-        y = self.get_field(self.y_magnet_socket)
-        z = self.get_field(self.z_magnet_socket)
+        timestamp, x, y, z = self.get_fields()
         return np.sqrt(x * x + y * y + z * z)
 
     def set_radius(self, value):
@@ -942,9 +1751,7 @@ class Driver(LabberDriver):
                  theta (np.rad2deg(np.arccos(z / radius)))
         :rtype: tuple
         """
-        x = self.get_field(self.x_magnet_socket)
-        y = self.get_field(self.y_magnet_socket)
-        z = self.get_field(self.z_magnet_socket)
+        timestamp, x, y, z = self.get_fields()
 
         radius = np.sqrt(x * x + y * y + z * z)
         phi = np.rad2deg(np.arctan2(y, x))
@@ -952,7 +1759,241 @@ class Driver(LabberDriver):
 
         return radius, phi, theta
 
+    def start_arc_sweep(self, angle, value, sweep_rate):
+        """
+        Start a continuous sweep of theta or phi at constant radius. The arc is split into straight segments, each of
+        them takes about arc_segment_time to ramp at the ramp rates of the magnets. Set points are sent at the times
+        given by the sweep rate (or as soon as the magnets get there, if the sweep rate is faster) from
+        checkIfSweeping, without pausing the magnets between the segments. Segments that would come closer than
+        trajectory_margin to combined_field_limit while the axes ramp with different rates are split further. If the
+        measured field is not at the start of the arc, the magnets are ramped there first (see
+        start_ramping_algorithm), and the first segment starts from the measured field.
+
+        :param angle: Name of the swept angle, theta or phi
+        :type angle: str
+        :param value: Angle at the end of the sweep (degrees)
+        :type value: float
+        :param sweep_rate: Requested sweep rate (degrees per second)
+        :type sweep_rate: float
+        :return: Angle at the end of the sweep
+        :rtype: float
+        """
+        radius = self.get_constant_radius()
+        field_limit = self.combined_field_limit - self.trajectory_margin
+        if abs(radius) > field_limit:
+            raise ValueError("Arc sweeps are limited to a radius of {} T".format(field_limit))
+        start = self.get_constant_theta() if angle == "theta" else self.get_constant_phi()
+        arc_start = np.array(self.spherical_to_cartesian(radius, np.deg2rad(self.get_constant_phi()),
+                                                         np.deg2rad(self.get_constant_theta())))
+        field = np.array(self.get_fields(max_age=0)[1:])
+        if np.linalg.norm(field - arc_start) > self.arc_start_tolerance:
+            if not self.start_ramping_algorithm(*arc_start):
+                return start
+            field = np.array(self.get_fields(max_age=0)[1:])
+
+        # any field component stays within the radius during the sweep
+        bound = max(abs(radius), np.max(np.abs(field)))
+        ramp_rates = np.array([self.get_slowest_ramp_rate(magnet_socket, -bound, bound)
+                               for magnet_socket in self.magnet_sockets()])
+
+        # fastest angular speed every magnet can follow anywhere on the arc (no field component changes faster than
+        # radius times the angular speed)
+        max_rate = np.rad2deg(min(ramp_rates) / abs(radius)) if radius else abs(sweep_rate)
+        segments = max(int(np.ceil(abs(value - start) / (max_rate * self.arc_segment_time))), 1)
+        while True:
+            points = []
+            for angle_value in np.linspace(start, value, segments + 1):
+                theta = angle_value if angle == "theta" else self.get_constant_theta()
+                phi = angle_value if angle == "phi" else self.get_constant_phi()
+                points.append(np.array(self.spherical_to_cartesian(radius, np.deg2rad(phi), np.deg2rad(theta))))
+            # first segment starts where the magnets really are
+            points[0] = field
+            if all(segment_is_safe(points[i], points[i + 1], ramp_rates, field_limit)
+                   for i in range(segments)):
+                break
+            segments *= 2
+
+        self.arc_sweep = {"quant": angle, "value": value, "points": points[1:], "index": 0,
+                          "ramp_rates": ramp_rates, "start_time": time.time(),
+                          "step_time": abs(value - start) / abs(sweep_rate) / segments}
+        self.send_arc_set_point()
+        return value
+
+    def send_arc_set_point(self):
+        """
+        Send the current set point of the arc sweep to all 3 magnets. Magnets that are already ramping keep ramping,
+        only their target changes.
+
+        :return: NoneType
+        """
+        point = self.arc_sweep["points"][self.arc_sweep["index"]]
+        for magnet_socket, target in zip((self.x_magnet_socket, self.y_magnet_socket, self.z_magnet_socket), point):
+            self._send_many(magnet_socket, ["CONF:FIELD:TARG {}".format(float(target)), "RAMP"])
+
+    def advance_arc_sweep(self):
+        """
+        Check the progress of the arc sweep. When the magnets are about to reach the current set point and the next
+        one is due according to the sweep rate, the next set point is sent. All magnets are paused and the sweep ends
+        if the field leaves combined_field_limit or any magnet is neither ramping nor holding.
+
+        :return: True if the sweep is still running, False if it finished or was stopped
+        :rtype: bool
+        """
+        sweep = self.arc_sweep
+        timestamp, statuses = self.get_statuses(max_age=0)
+        x, y, z = [status["field"] for status in statuses]
+        ramp_states = [status["rampState"] for status in statuses]
+        self.reportStatus("X: {}, Y: {}, Z: {}".format(x, y, z))
+        # a magnet that is paused, quenched, zeroing or switching would never reach its set point
+        if np.sqrt(x * x + y * y + z * z) > self.combined_field_limit or \
+                any(state not in (0, 1) for state in ramp_states):
+            self.performStopSweep(None)
+            return False
+
+        point = sweep["points"][sweep["index"]]
+        remaining = max(abs(point[i] - (x, y, z)[i]) / sweep["ramp_rates"][i] for i in range(3))
+        if sweep["index"] == len(sweep["points"]) - 1:
+            if all(state == 1 for state in ramp_states):
+                self.arc_sweep = None
+                if sweep["quant"] == "theta":
+                    self.set_constant_theta(sweep["value"])
+                else:
+                    self.set_constant_phi(sweep["value"])
+                return False
+        elif remaining < self.arc_lead_time and \
+                time.time() >= sweep["start_time"] + (sweep["index"] + 1) * sweep["step_time"] - self.arc_lead_time:
+            sweep["index"] += 1
+            self.send_arc_set_point()
+        return True
+
+    def get_move_ramp_rates(self, fields, targets):
+        """
+        Slowest ramp rate of the x, y and z magnet on the way from the current fields to the targets, see
+        get_slowest_ramp_rate.
+
+        :param fields: Current field of the x, y and z magnet
+        :type fields: tuple
+        :param targets: Target field of the x, y and z magnet
+        :type targets: tuple
+        :return: Ramp rates of the x, y and z magnet
+        :rtype: list
+        """
+        return [self.get_slowest_ramp_rate(magnet_socket, field, target)
+                for magnet_socket, field, target in zip(self.magnet_sockets(), fields, targets)]
+
+    def monitor_poll_interval(self, fields, targets, ramp_rates, ramp_states, radius, field_limit):
+        """
+        Time to sleep before the next check of the ramping algorithm. The next event is the first of: a ramping magnet
+        reaching its target, the combined field reaching the stop threshold (or falling to the restart threshold), the
+        combined field reaching the limit at which the algorithm pauses all magnets.
+        The combined field can not change faster than the length of the vector of ramp rates of the magnets that are
+        currently ramping, which gives a lower bound on the time until a threshold is crossed.
+
+        :param fields: Current field of the x, y and z magnet
+        :type fields: tuple
+        :param targets: Target field of the x, y and z magnet
+        :type targets: tuple
+        :param ramp_rates: Ramp rate of the x, y and z magnet
+        :type ramp_rates: list
+        :param ramp_states: Ramp state of the x, y and z magnet
+        :type ramp_states: tuple
+        :param radius: Current value of the combined field
+        :type radius: float
+        :param field_limit: Combined field at which the algorithm pauses all magnets
+        :type field_limit: float
+        :return: Time to sleep in seconds
+        :rtype: float
+        """
+        ramping = [i for i in range(3) if ramp_states[i] == 0]
+        if not ramping:
+            return self.min_poll_interval
+
+        events = [abs(targets[i] - fields[i]) / ramp_rates[i] for i in ramping]
+        radius_rate = np.sqrt(sum(ramp_rates[i] ** 2 for i in ramping))
+        if radius < self.stop_threshold:
+            events.append((self.stop_threshold - radius) / radius_rate)
+        if radius < field_limit:
+            events.append((field_limit - radius) / radius_rate)
+        if radius > self.restart_all_threshold:
+            events.append((radius - self.restart_all_threshold) / radius_rate)
+        return self.next_poll_interval(min(events))
+
     def start_ramping_algorithm(self, target_x, target_y, target_z):
+        """
+        This method is used to change the result field of all 3 magnets in any way. The path from the current field to
+        the target is planned in advance (see trajectory_planner.plan_trajectory): it is split into segments on which
+        all 3 magnets can ramp at the same time with the combined field staying trajectory_margin inside
+        combined_field_limit. The magnets then ramp segment by segment. If no such path exists (ex. the current field
+        or the target is outside the planning limit), the reactive algorithm is used instead.
+
+        :param target_x: X magnet will ramp to this value
+        :type target_x: float
+        :param target_y: Y magnet will ramp to this value
+        :type target_y: float
+        :param target_z: Z magnet will ramp to this value
+        :type target_z: float
+        :return: True if successful, else False
+        :rtype: bool
+        """
+        target_radius = np.sqrt(target_x * target_x + target_y * target_y + target_z * target_z)
+        if target_radius > self.combined_field_limit:
+            self.getValueFromUserDialog(value="Don't put anything here",
+                                        text="Field will exceed the maximum allowed value (sweep canceled)",
+                                        title="Burn after reading")
+            return False
+
+        timestamp, x, y, z = self.get_fields(max_age=0)
+        ramp_rates = self.get_move_ramp_rates((x, y, z), (target_x, target_y, target_z))
+        try:
+            set_points = plan_trajectory((x, y, z), (target_x, target_y, target_z), ramp_rates,
+                                         self.combined_field_limit - self.trajectory_margin)
+        except ValueError as e:
+            logging.warning(__name__ + ': ' + str(e) + ', using the reactive ramping algorithm')
+            return self.ramp_reactively(target_x, target_y, target_z)
+
+        for set_point in set_points:
+            if not self.ramp_segment(set_point, ramp_rates):
+                return False
+        return True
+
+    def ramp_segment(self, targets, ramp_rates):
+        """
+        Ramp all 3 magnets at the same time to the given set points and wait until all of them hold. The combined
+        field is checked on every poll, if it ever leaves combined_field_limit (or a magnet stops for any other reason)
+        all magnets are paused.
+
+        :param targets: Set points of the x, y and z magnet
+        :type targets: tuple | np.ndarray
+        :param ramp_rates: Ramp rate of the x, y and z magnet
+        :type ramp_rates: list
+        :return: True if all magnets reached their set points, else False
+        :rtype: bool
+        """
+        sockets = (self.x_magnet_socket, self.y_magnet_socket, self.z_magnet_socket)
+        for magnet_socket, target in zip(sockets, targets):
+            self.set_field(magnet_socket, target)
+
+        while True:
+            timestamp, x, y, z = self.get_fields(max_age=0)
+            radius = np.sqrt(x * x + y * y + z * z)
+            self.reportStatus("X: {}, Y: {}, Z: {}".format(x, y, z))
+            ramp_states = self.poll_magnets(self.get_ramp_state)
+
+            if self.isStopped() or radius > self.combined_field_limit or \
+                    any(state not in (0, 1) for state in ramp_states):
+                for magnet_socket in sockets:
+                    self.pause_ramp(magnet_socket)
+                return False
+            if all(state == 1 for state in ramp_states):
+                return True
+
+            # next event is one of the magnets reaching its set point, or the field reaching the limit
+            ramping = [i for i in range(3) if ramp_states[i] == 0]
+            events = [abs(targets[i] - (x, y, z)[i]) / ramp_rates[i] for i in ramping]
+            events.append((self.combined_field_limit - radius) / np.sqrt(sum(ramp_rates[i] ** 2 for i in ramping)))
+            time.sleep(self.next_poll_interval(min(events)))
+
+    def ramp_reactively(self, target_x, target_y, target_z):
         """
         This method is used to change the result field of all 3 magnets in any way. Since it is required to have some
         safety not all magnets will ramp at the same time. There are 2 important numbers in this method: first one is
@@ -990,9 +2031,7 @@ class Driver(LabberDriver):
             self.set_set_point(self.y_magnet_socket, target_y)
             self.set_set_point(self.z_magnet_socket, target_z)
 
-        x = self.get_field(self.x_magnet_socket)
-        y = self.get_field(self.y_magnet_socket)
-        z = self.get_field(self.z_magnet_socket)
+        timestamp, x, y, z = self.get_fields()
         radius, phi, theta = self.cartesian_to_spherical(x, y, z)
 
         if radius < self.restart_all_threshold:
@@ -1016,9 +2055,8 @@ class Driver(LabberDriver):
                 if np.abs(target_z) < np.abs(z):
                     self.start_ramping(self.z_magnet_socket)
 
-        x_ramp_state = self.get_ramp_state(self.x_magnet_socket)
-        y_ramp_state = self.get_ramp_state(self.y_magnet_socket)
-        z_ramp_state = self.get_ramp_state(self.z_magnet_socket)
+        x_ramp_state, y_ramp_state, z_ramp_state = self.poll_magnets(self.get_ramp_state)
+        ramp_rates = self.get_move_ramp_rates((x, y, z), (target_x, target_y, target_z))
 
         # loop that keeps checking if we left the the safe zone, and stop some magnets if we did
         # additionally it keeps checking if we went back to the safe zone and restarts the magnets
@@ -1030,9 +2068,8 @@ class Driver(LabberDriver):
                 self.pause_ramp(self.z_magnet_socket)
                 return False
 
-            x = self.get_field(self.x_magnet_socket)
-            y = self.get_field(self.y_magnet_socket)
-            z = self.get_field(self.z_magnet_socket)
+            # fresh snapshot of every magnet, ramp states below are read from the same snapshot
+            timestamp, x, y, z = self.get_fields(max_age=0)
             radius, phi, theta = self.cartesian_to_spherical(x, y, z)
             self.reportStatus("X: {}, Y: {}, Z: {}".format(x, y, z))
 
@@ -1124,15 +2161,14 @@ class Driver(LabberDriver):
                     if finished:
                         return True
 
-            x_ramp_state = self.get_ramp_state(self.x_magnet_socket)
-            y_ramp_state = self.get_ramp_state(self.y_magnet_socket)
-            z_ramp_state = self.get_ramp_state(self.z_magnet_socket)
-            time.sleep(0.5)
+            x_ramp_state, y_ramp_state, z_ramp_state = self.poll_magnets(self.get_ramp_state)
 
             # Make sure the result field is close to zero when the measurement is done
             if x_ramp_state == 1 and y_ramp_state == 1 and z_ramp_state == 1:
-                time.sleep(1)
                 self.pause_ramp(self.x_magnet_socket)
                 self.pause_ramp(self.y_magnet_socket)
                 self.pause_ramp(self.z_magnet_socket)
                 return True
+
+            time.sleep(self.monitor_poll_interval((x, y, z), (target_x, target_y, target_z), ramp_rates,
+                                                  (x_ramp_state, y_ramp_state, z_ramp_state), radius, 0.9))
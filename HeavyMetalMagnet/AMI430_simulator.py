@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+
+import math
+import socket
+import socketserver
+import threading
+import time
+
+
+class SimulationClock(object):
+    """
+    Clock shared by all simulated supplies. Simulated time runs acceleration times faster than the wall clock, so a
+    ramp that takes hours on the real magnet can be replayed in seconds.
+    """
+
+    def __init__(self, acceleration=1.0):
+        """
+        :param acceleration: How many simulated seconds pass in one second of the wall clock
+        :type acceleration: float
+        """
+        self.acceleration = acceleration
+        self.start = time.time()
+
+    def now(self):
+        """
+        :return: Simulated time in seconds since the clock was created
+        :rtype: float
+        """
+        return (time.time() - self.start) * self.acceleration
+
+
+class SimulatedSupply(object):
+    """
+    Model of one AMI430 power supply programmer. Field is integrated over simulated time from the configured ramp rate,
+    the states and replies use the same codes as the real instrument (STATE? is 1 based). Field of the leads (supply
+    output) and field in the magnet are kept separately: the magnet follows the leads only while the persistent switch
+    is heated, once it is cooled the magnet keeps its field and the leads can be ramped to zero.
+    """
+
+    RAMPING = 1
+    HOLDING = 2
+    PAUSED = 3
+    ZEROING = 6
+    QUENCH = 7
+    AT_ZERO = 8
+    HEATING = 9
+    COOLING = 10
+
+    # Time (simulated seconds) it takes to heat or cool the persistent switch
+    switch_time = 20.0
+
+    def __init__(self, clock, ramp_rate, field_rating, coil_constant=0.1):
+        """
+        :param clock: Clock shared by all supplies of the simulator
+        :type clock: SimulationClock
+        :param ramp_rate: Ramp rate in T/s
+        :type ramp_rate: float
+        :param field_rating: Field above which the magnet quenches (T)
+        :type field_rating: float
+        :param coil_constant: Field per unit of current (T/A)
+        :type coil_constant: float
+        """
+        self.clock = clock
+        self.field_rating = field_rating
+        # ramp table, (rate, upper field) of every segment ordered by the upper field
+        self.ramp_segments = [(ramp_rate, field_rating)]
+        self.coil_constant = coil_constant
+
+        # field the supply drives through the leads, and the field in the magnet
+        self.field = 0.0
+        self.magnet_field = 0.0
+        self.target = 0.0
+        self.state = self.PAUSED
+        self.state_after_switch = self.PAUSED
+        self.switch_done = 0.0
+        self.p_switch = 1
+        self.quench = 0
+        self.units = 1
+        self.errors = []
+        self.last_update = clock.now()
+        self.lock = threading.Lock()
+
+        # number of lines, commands and queries received over the network
+        self.io_counts = {"lines": 0, "commands": 0, "queries": 0}
+
+    def update(self):
+        """
+        Advance the simulation to the current simulated time.
+
+        :return: NoneType
+        """
+        now = self.clock.now()
+        dt = now - self.last_update
+        self.last_update = now
+
+        if self.state in (self.RAMPING, self.ZEROING):
+            target = self.target if self.state == self.RAMPING else 0.0
+            self.ramp(target, dt)
+            if self.field == target:
+                self.state = self.HOLDING if self.state == self.RAMPING else self.AT_ZERO
+            if abs(self.field) > self.field_rating:
+                self.state = self.QUENCH
+                self.quench = 1
+        elif self.state in (self.HEATING, self.COOLING) and now >= self.switch_done:
+            self.state = self.state_after_switch
+        # heated switch connects the magnet to the leads, a cooled (or still heating) one keeps the field in the magnet
+        if self.p_switch and self.state != self.HEATING:
+            self.magnet_field = self.field
+
+    def ramp_rate(self, field):
+        """
+        :param field: Magnitude of the field (T)
+        :type field: float
+        :return: Ramp rate of the segment of the ramp table the field is in (T/s)
+        :rtype: float
+        """
+        for rate, upper in self.ramp_segments:
+            if field < upper:
+                return rate
+        return self.ramp_segments[-1][0]
+
+    def ramp(self, target, dt):
+        """
+        Move the field towards the target for dt seconds, segment by segment of the ramp table.
+
+        :param target: Field to ramp to (T)
+        :type target: float
+        :param dt: Simulated time (seconds)
+        :type dt: float
+        :return: NoneType
+        """
+        while dt > 0 and self.field != target:
+            direction = math.copysign(1.0, target - self.field)
+            # end of this piece: the target, zero or the next segment boundary in the direction of the ramp
+            stops = [0.0] + [sign * upper for _, upper in self.ramp_segments for sign in (1, -1)]
+            stops = [stop for stop in stops if (stop - self.field) * direction > 0 and (target - stop) * direction > 0]
+            stop = min(stops + [target], key=lambda value: abs(value - self.field))
+            rate = self.ramp_rate(abs((self.field + stop) / 2))
+            if abs(stop - self.field) <= rate * dt:
+                dt -= abs(stop - self.field) / rate
+                self.field = stop
+            else:
+                self.field += direction * rate * dt
+                dt = 0
+
+    def execute(self, line):
+        """
+        Execute one line received from the driver. A line can hold several semicolon separated commands, every query
+        produces one reply.
+
+        :param line: Line without the terminator
+        :type line: str
+        :return: Replies to the queries in the line, in order
+        :rtype: list
+        """
+        replies = []
+        with self.lock:
+            self.update()
+            self.io_counts["lines"] += 1
+            for command in line.split(";"):
+                command = command.strip()
+                if not command:
+                    continue
+                if command.endswith("?"):
+                    self.io_counts["queries"] += 1
+                    replies.append(self.query(command.upper()))
+                else:
+                    self.io_counts["commands"] += 1
+                    self.command(command.upper())
+        return replies
+
+    def query(self, query):
+        """
+        :param query: Query in upper case (ex. FIELD:MAG?)
+        :type query: str
+        :return: Reply of the instrument
+        :rtype: str
+        """
+        if query == "STATE?":
+            return str(self.state)
+        elif query == "FIELD:MAG?":
+            return "{:.8f}".format(self.magnet_field)
+        elif query == "FIELD:TARG?":
+            return "{:.8f}".format(self.target)
+        elif query == "CURR:MAG?":
+            return "{:.8f}".format(self.magnet_field / self.coil_constant)
+        elif query == "CURR:SUPP?":
+            return "{:.8f}".format(self.field / self.coil_constant)
+        elif query == "CURR:TARG?":
+            return "{:.8f}".format(self.target / self.coil_constant)
+        elif query.startswith("RAMP:RATE:FIELD:"):
+            rate, upper = self.ramp_segments[int(query[16:-1]) - 1]
+            return "{},{}".format(rate, upper)
+        elif query == "RAMP:RATE:SEG?":
+            return str(len(self.ramp_segments))
+        elif query == "COIL?":
+            return str(self.coil_constant)
+        elif query == "PS?":
+            return str(self.p_switch)
+        elif query == "PERS?":
+            # persistent once the switch is cooled
+            return "1" if not self.p_switch and self.state != self.COOLING else "0"
+        elif query == "QU?":
+            return str(self.quench)
+        elif query == "FIELD:UNITS?":
+            return str(self.units)
+        elif query == "SYST:ERR?":
+            return self.errors.pop(0) if self.errors else "0,No error"
+        self.errors.append("-113,Undefined header")
+        return ""
+
+    def command(self, command):
+        """
+        :param command: Command in upper case (ex. CONF:FIELD:TARG 0.5)
+        :type command: str
+        :return: NoneType
+        """
+        name, _, argument = command.partition(" ")
+        arguments = [value.strip() for value in argument.split(",")] if argument else []
+
+        if self.state == self.QUENCH and name not in ("QU", "PAUSE"):
+            self.errors.append("-200,Magnet quench")
+        elif name == "RAMP":
+            self.state = self.RAMPING
+        elif name == "PAUSE":
+            self.state = self.PAUSED
+        elif name == "ZERO":
+            self.state = self.ZEROING
+        elif name == "CONF:FIELD:TARG":
+            self.target = float(arguments[0])
+        elif name == "CONF:CURR:TARG":
+            self.target = float(arguments[0]) * self.coil_constant
+        elif name == "CONF:RAMP:RATE:SEG":
+            segments = int(arguments[0])
+            self.ramp_segments = (self.ramp_segments + [self.ramp_segments[-1]] * segments)[:segments]
+        elif name == "CONF:RAMP:RATE:FIELD":
+            self.ramp_segments[int(arguments[0]) - 1] = (float(arguments[1]), float(arguments[2]))
+        elif name == "CONF:FIELD:UNITS":
+            self.units = int(arguments[0])
+        elif name == "PS":
+            self.state_after_switch = self.state
+            self.state = self.HEATING if int(arguments[0]) else self.COOLING
+            self.switch_done = self.clock.now() + self.switch_time
+            self.p_switch = int(arguments[0])
+        elif name == "QU":
+            self.quench = 0
+            self.state = self.PAUSED
+        else:
+            self.errors.append("-113,Undefined header")
+
+
+class SupplyHandler(socketserver.StreamRequestHandler):
+    """
+    Connection to one simulated supply. Sends the welcome message and then answers the driver line by line.
+    """
+
+    BANNER = b"American Magnetics Model 430 IP Interface\r\nHello.\r\n"
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        # replies are small, send them right away like the instrument does
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        self.wfile.write(self.BANNER)
+        for line in self.rfile:
+            replies = self.server.supply.execute(line.decode("ASCII"))
+            if replies:
+                self.wfile.write("".join(reply + "\r\n" for reply in replies).encode("ASCII"))
+
+
+class AMI430Simulator(object):
+    """
+    Local TCP stand in for the three AMI430 supplies of the vector magnet. Every supply listens on its own port, so
+    the driver connects to it exactly like to the real instruments.
+    """
+
+    # Ramp rate (T/s) and field rating (T) of the x, y and z supply, same as in the driver and its .ini file
+    supply_settings = {"x": (0.0024, 1.01), "y": (0.0025, 0.98), "z": (0.0057, 5.99)}
+
+    def __init__(self, acceleration=1.0, host="127.0.0.1"):
+        """
+        :param acceleration: How many simulated seconds pass in one second of the wall clock
+        :type acceleration: float
+        :param host: Address the supplies listen on, ports are picked by the operating system
+        :type host: str
+        """
+        self.clock = SimulationClock(acceleration)
+        self.supplies = {}
+        self.servers = {}
+        for axis, (ramp_rate, field_rating) in self.supply_settings.items():
+            server = socketserver.ThreadingTCPServer((host, 0), SupplyHandler)
+            server.daemon_threads = True
+            server.supply = SimulatedSupply(self.clock, ramp_rate, field_rating)
+            self.servers[axis] = server
+            self.supplies[axis] = server.supply
+
+    def address(self, axis):
+        """
+        :param axis: x, y or z
+        :type axis: str
+        :return: (host, port) of the supply
+        :rtype: tuple
+        """
+        return self.servers[axis].server_address
+
+    def start(self):
+        """
+        Start serving all supplies in background threads.
+
+        :return: NoneType
+        """
+        for server in self.servers.values():
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """
+        Stop all supplies and close their ports.
+
+        :return: NoneType
+        """
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def io_counts(self):
+        """
+        :return: Number of lines, commands and queries received by all supplies together
+        :rtype: dict
+        """
+        total = {"lines": 0, "commands": 0, "queries": 0}
+        for supply in self.supplies.values():
+            for key in total:
+                total[key] += supply.io_counts[key]
+        return total
+
+
+def main():
+    """
+    Benchmark of a vector sweep on the simulator. Reports the time needed for the whole sweep (wall clock and
+    simulated) and the number of I/O operations the driver needed for it.
+    """
+    # driver is imported here, so the simulator itself can run without Labber installed
+    import numpy as np
+    from AMI430 import Driver
+
+    class SimulatedDriver(Driver):
+        """
+        AMI430 driver connected to the simulator. Labber callbacks are replaced so it runs outside of Labber.
+        """
+
+        def __init__(self, simulator):
+            self.values = {"status_cache_time": 0.2, "x_rampTable": "", "y_rampTable": "", "z_rampTable": ""}
+            self.acceleration = simulator.clock.acceleration
+            self.x_magnet_IP, self.x_magnet_PORT = simulator.address("x")
+            self.y_magnet_IP, self.y_magnet_PORT = simulator.address("y")
+            self.z_magnet_IP, self.z_magnet_PORT = simulator.address("z")
+
+        def getValue(self, name):
+            return self.values[name]
+
+        def isStopped(self):
+            return False
+
+        def reportStatus(self, message):
+            pass
+
+        def getValueFromUserDialog(self, value=None, text="", title=""):
+            raise RuntimeError(text)
+
+        def next_poll_interval(self, remaining_time):
+            # predictions are made in simulated time, the driver sleeps in wall clock time
+            return Driver.next_poll_interval(self, remaining_time / self.acceleration)
+
+    acceleration = 50.0
+    simulator = AMI430Simulator(acceleration)
+    simulator.start()
+    driver = SimulatedDriver(simulator)
+    driver.performOpen()
+
+    # (radius, theta, phi) of every step of the sweep, last step brings the field back to zero
+    sweep = [(0.5, 0.0, 0.0), (0.5, 45.0, 0.0), (0.5, 90.0, 90.0), (0.82, 90.0, 45.0), (0.0, 0.0, 0.0)]
+    print("{:>6} {:>6} {:>6} {:>10} {:>12} {:>8} {:>8}".format("r", "theta", "phi", "wall [s]", "simulated [s]",
+                                                              "lines", "queries"))
+    start = time.time()
+    for radius, theta, phi in sweep:
+        x, y, z = driver.spherical_to_cartesian(radius, np.deg2rad(phi), np.deg2rad(theta))
+        counts = simulator.io_counts()
+        step_start = time.time()
+        driver.start_ramping_algorithm(x, y, z)
+        step_time = time.time() - step_start
+        step_counts = simulator.io_counts()
+        print("{:>6} {:>6} {:>6} {:>10.2f} {:>12.1f} {:>8} {:>8}".format(
+            radius, theta, phi, step_time, step_time * acceleration,
+            step_counts["lines"] - counts["lines"], step_counts["queries"] - counts["queries"]))
+    total_time = time.time() - start
+    counts = simulator.io_counts()
+    print("Total: {:.2f} s wall, {:.1f} s simulated, {} lines, {} commands, {} queries".format(
+        total_time, total_time * acceleration, counts["lines"], counts["commands"], counts["queries"]))
+
+    driver.performClose()
+    simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import glob
+import os.path
+import tempfile
+import threading
+import time
+import numpy as np
+
+
+class TelemetryRecorder(object):
+    """
+    Recorder of the magnet status during ramps. Rows are written into a preallocated ring buffer, which costs one
+    array assignment in the control loop. A background thread writes the recorded rows to numbered .npy chunks in the
+    session directory, files are only ever added, never rewritten.
+    """
+
+    # One row of the telemetry, every array has one value per axis (x, y, z)
+    dtype = np.dtype([("time", "f8"),
+                      ("field", "f8", (3,)),
+                      ("current", "f8", (3,)),
+                      ("target", "f8", (3,)),
+                      ("state", "i1", (3,)),
+                      ("quench", "?", (3,))])
+
+    def __init__(self, directory, capacity=100000, flush_interval=5.0):
+        """
+        :param directory: Directory in which a new session directory with the chunks is created
+        :type directory: str
+        :param capacity: Number of rows the ring buffer holds
+        :type capacity: int
+        :param flush_interval: Time between two writes of the recorded rows to disk (seconds)
+        :type flush_interval: float
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # suffix makes the name unique, a recorder started within the same second never writes into the chunks of
+        # another one
+        self.directory = tempfile.mkdtemp(prefix=time.strftime("session_%Y%m%d_%H%M%S_"), dir=directory)
+        self.buffer = np.zeros(capacity, dtype=self.dtype)
+        self.flush_interval = flush_interval
+        # total number of rows recorded and written to disk since the recorder was created
+        self.recorded = 0
+        self.written = 0
+        # rows that were overwritten in the ring buffer before they could be written to disk
+        self.dropped = 0
+        self.chunk = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, timestamp, statuses):
+        """
+        Record one row.
+
+        :param timestamp: Time of the row (seconds since the epoch)
+        :type timestamp: float
+        :param statuses: Status snapshots of the x, y and z magnet (see AMI430 Driver.get_status)
+        :type statuses: list
+        :return: NoneType
+        """
+        with self.lock:
+            row = self.buffer[self.recorded % len(self.buffer)]
+            row["time"] = timestamp
+            row["field"] = [status["field"] for status in statuses]
+            row["current"] = [status["current"] for status in statuses]
+            row["target"] = [status["setPoint"] for status in statuses]
+            row["state"] = [status["rampState"] for status in statuses]
+            row["quench"] = [status["quench"] for status in statuses]
+            self.recorded += 1
+
+    def flush(self):
+        """
+        Write all the rows recorded since the last flush to a new chunk file.
+
+        :return: NoneType
+        """
+        with self.lock:
+            start, end = self.written, self.recorded
+            if end - start > len(self.buffer):
+                self.dropped += end - start - len(self.buffer)
+                start = end - len(self.buffer)
+            indices = np.arange(start, end) % len(self.buffer)
+            rows = self.buffer[indices]
+            self.written = end
+        if len(rows):
+            np.save(os.path.join(self.directory, "chunk_{:06d}.npy".format(self.chunk)), rows)
+            self.chunk += 1
+
+    def writer(self):
+        """
+        Loop of the background thread that writes the recorded rows to disk.
+
+        :return: NoneType
+        """
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """
+        Stop the background thread and write the remaining rows.
+
+        :return: NoneType
+        """
+        self.stop_event.set()
+        self.thread.join()
+        self.flush()
+
+
+def load(directory):
+    """
+    Load all chunks of one recording session into one array.
+
+    :param directory: Session directory created by a TelemetryRecorder
+    :type directory: str
+    :return: Rows of the session, ordered by time
+    :rtype: np.ndarray
+    """
+    chunks = [np.load(path) for path in sorted(glob.glob(os.path.join(directory, "chunk_*.npy")))]
+    if not chunks:
+        return np.zeros(0, dtype=TelemetryRecorder.dtype)
+    return np.concatenate(chunks)
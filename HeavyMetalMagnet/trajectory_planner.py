@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+
+def segment_corners(start, target, ramp_rates):
+    """
+    Points where the path of one segment changes direction. All axes start ramping at the same time, each one with its
+    own ramp rate, so the path is piecewise linear with a corner every time one of the axes reaches its target.
+
+    :param start: Field at the beginning of the segment (x, y, z)
+    :type start: np.ndarray
+    :param target: Field at the end of the segment (x, y, z)
+    :type target: np.ndarray
+    :param ramp_rates: Ramp rate of every axis (T/s)
+    :type ramp_rates: np.ndarray
+    :return: (corners, duration): points of the path including start and target, and the time the segment takes
+    :rtype: tuple
+    """
+    delta = target - start
+    finish_times = np.abs(delta) / ramp_rates
+    corners = [start]
+    for t in np.sort(finish_times):
+        corners.append(start + np.sign(delta) * np.minimum(ramp_rates * t, np.abs(delta)))
+    return np.array(corners), np.max(finish_times)
+
+
+def segment_is_safe(start, target, ramp_rates, field_limit):
+    """
+    Check if the magnitude of the field stays inside the limit for the whole segment. The magnitude is a convex
+    function along every straight piece of the path, so it is enough to check the corners.
+
+    :param start: Field at the beginning of the segment (x, y, z)
+    :type start: np.ndarray
+    :param target: Field at the end of the segment (x, y, z)
+    :type target: np.ndarray
+    :param ramp_rates: Ramp rate of every axis (T/s)
+    :type ramp_rates: np.ndarray
+    :param field_limit: Maximum allowed magnitude of the field (T)
+    :type field_limit: float
+    :return: True if the magnitude stays inside the limit
+    :rtype: bool
+    """
+    corners, duration = segment_corners(start, target, ramp_rates)
+    return np.all(np.linalg.norm(corners, axis=1) <= field_limit)
+
+
+def plan_trajectory(start, target, ramp_rates, field_limit, tolerance=1e-3):
+    """
+    Plan intermediate set points from start to target, such that the magnitude of the field stays inside the limit
+    while all axes ramp at the same time. Set points lie on the straight line from start to target (which is inside
+    the limit because both ends are). Each segment is made as long as possible: the end of the segment is the
+    furthest point of the line that can still be reached safely, found with a binary search.
+
+    :param start: Current field (x, y, z)
+    :type start: tuple | np.ndarray
+    :param target: Target field (x, y, z)
+    :type target: tuple | np.ndarray
+    :param ramp_rates: Ramp rate of every axis (T/s)
+    :type ramp_rates: tuple | list | np.ndarray
+    :param field_limit: Maximum allowed magnitude of the field (T)
+    :type field_limit: float
+    :param tolerance: Resolution of the binary search, as a fraction of the whole line
+    :type tolerance: float
+    :return: Set points to ramp to one after another, the last one is the target
+    :rtype: list
+    """
+    start = np.asarray(start, dtype=float)
+    target = np.asarray(target, dtype=float)
+    ramp_rates = np.asarray(ramp_rates, dtype=float)
+    if np.linalg.norm(start) > field_limit or np.linalg.norm(target) > field_limit:
+        raise ValueError("Start and target field have to be inside the field limit")
+
+    def point(fraction):
+        return start + (target - start) * fraction
+
+    set_points = []
+    position = 0.0
+    while not segment_is_safe(point(position), target, ramp_rates, field_limit):
+        low, high = position, 1.0
+        while high - low > tolerance:
+            middle = (low + high) / 2
+            if segment_is_safe(point(position), point(middle), ramp_rates, field_limit):
+                low = middle
+            else:
+                high = middle
+        if low == position:
+            raise ValueError("No safe path found, the line from start to target is too close to the field limit")
+        position = low
+        set_points.append(point(position))
+    set_points.append(target)
+    return set_points
+
+
+def plan_duration(start, set_points, ramp_rates):
+    """
+    Time needed to follow a plan, when every segment waits for all axes to reach their set points.
+
+    :param start: Current field (x, y, z)
+    :type start: tuple | np.ndarray
+    :param set_points: Set points returned by plan_trajectory
+    :type set_points: list
+    :param ramp_rates: Ramp rate of every axis (T/s)
+    :type ramp_rates: tuple | list | np.ndarray
+    :return: Duration in seconds
+    :rtype: float
+    """
+    duration = 0.0
+    position = np.asarray(start, dtype=float)
+    for set_point in set_points:
+        duration += np.max(np.abs(set_point - position) / np.asarray(ramp_rates, dtype=float))
+        position = set_point
+    return duration
+
+
+def simulate_reactive(start, target, ramp_rates, restart_all_threshold, stop_threshold, poll_interval=0.5):
+    """
+    Duration of the same move with the reactive algorithm of the driver (start all axes in the safe zone, pause the
+    axes that increase the field above the stop threshold, restart them below the restart threshold, one axis at a
+    time in between). Latency of the instrument communication is ignored, only the poll interval is taken into
+    account.
+
+    :param start: Current field (x, y, z)
+    :type start: tuple | np.ndarray
+    :param target: Target field (x, y, z)
+    :type target: tuple | np.ndarray
+    :param ramp_rates: Ramp rate of every axis (T/s)
+    :type ramp_rates: tuple | list | np.ndarray
+    :param restart_all_threshold: Magnitude below which all axes ramp
+    :type restart_all_threshold: float
+    :param stop_threshold: Magnitude above which only one axis ramps
+    :type stop_threshold: float
+    :param poll_interval: Time between two checks of the algorithm (seconds)
+    :type poll_interval: float
+    :return: (duration, maximum magnitude of the field during the move)
+    :rtype: tuple
+    """
+    field = np.asarray(start, dtype=float).copy()
+    target = np.asarray(target, dtype=float)
+    ramp_rates = np.asarray(ramp_rates, dtype=float)
+
+    def decreasing(i):
+        return target[i] * field[i] >= 0 and abs(target[i]) < abs(field[i])
+
+    if np.linalg.norm(field) < restart_all_threshold:
+        ramping = np.ones(3, dtype=bool)
+    else:
+        ramping = np.array([decreasing(i) for i in range(3)])
+    duration = 0.0
+    max_radius = np.linalg.norm(field)
+
+    while True:
+        step = np.clip(target - field, -ramp_rates * poll_interval, ramp_rates * poll_interval)
+        field = np.where(ramping, field + step, field)
+        duration += poll_interval
+        max_radius = max(max_radius, np.linalg.norm(field))
+        holding = np.isclose(field, target)
+        ramping &= ~holding
+        paused = ~ramping & ~holding
+        if holding.all():
+            return duration, max_radius
+
+        radius = np.linalg.norm(field)
+        if radius >= stop_threshold:
+            if ramping.sum() > 1:
+                for i in range(3):
+                    if ramping[i] and target[i] * field[i] >= 0 and abs(target[i]) > abs(field[i]):
+                        ramping[i] = False
+            elif ramping.sum() < 1:
+                ramping[np.argmax(paused)] = True
+        elif radius < restart_all_threshold:
+            ramping |= paused
+        elif ramping.sum() < 1:
+            ramping[np.argmax(paused)] = True
+
+
+def main():
+    """
+    Benchmark of the planner against the reactive algorithm, on random moves of the HeavyMetal magnet.
+    """
+    ramp_rates = np.array([0.0024, 0.0025, 0.0057])
+    field_limit = 0.9
+    restart_all_threshold = 0.80
+    stop_threshold = 0.85
+
+    # moves along the limit (where the reactive algorithm serialises the axes) and random moves close to it
+    moves = [(np.array([0.85, 0.0, 0.0]), np.array([0.0, 0.0, 0.85])),
+             (np.array([0.0, 0.6, -0.6]), np.array([0.6, 0.0, 0.6]))]
+    random = np.random.RandomState(0)
+    for _ in range(20):
+        moves.append(tuple(v / np.linalg.norm(v) * random.uniform(0.7, 0.88) for v in random.normal(size=(2, 3))))
+
+    print("{:>26} {:>26} {:>12} {:>8} {:>12} {:>9}".format("start", "target", "reactive [s]", "max |B|",
+                                                            "planned [s]", "segments"))
+    total_reactive = total_planned = 0.0
+    for start, target in moves:
+        set_points = plan_trajectory(start, target, ramp_rates, field_limit)
+        planned = plan_duration(start, set_points, ramp_rates)
+        reactive, max_radius = simulate_reactive(start, target, ramp_rates, restart_all_threshold, stop_threshold)
+        total_reactive += reactive
+        total_planned += planned
+        print("{:>26} {:>26} {:>12.0f} {:>8.3f} {:>12.0f} {:>9}".format(np.array2string(start, precision=2),
+                                                                       np.array2string(target, precision=2),
+                                                                       reactive, max_radius, planned,
+                                                                       len(set_points)))
+    print("Total: reactive {:.0f} s, planned {:.0f} s".format(total_reactive, total_planned))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+
+from VISA_Driver import VISA_Driver
+import numpy as np
+import threading
+import time
+
+__version__ = "0.0.1"
+
+
+class ReadingRingBuffer(object):
+    """
+    Preallocated circular buffer of readings. Memory use is fixed by the size given at creation, no matter how long
+    the record runs, newest readings overwrite the oldest ones.
+    """
+
+    def __init__(self, size):
+        """
+        :param size: Maximum number of readings kept in the buffer
+        :type size: int
+        """
+        self.data = np.zeros(int(size))
+        self.index = 0  # position where the next reading will be written
+        self.count = 0  # total number of readings ever written to the buffer
+        self.lock = threading.Lock()
+
+    def extend(self, values):
+        """
+        Append readings to the buffer.
+
+        :param values: Readings to append
+        :type values: np.ndarray
+        :return: NoneType
+        """
+        size = len(self.data)
+        total = len(values)
+        values = values[-size:]
+        n = len(values)
+        with self.lock:
+            end = self.index + n
+            if end <= size:
+                self.data[self.index:end] = values
+            else:
+                first = size - self.index
+                self.data[self.index:] = values[:first]
+                self.data[:n - first] = values[first:]
+            self.index = end % size
+            self.count += total
+
+    def latest(self, n):
+        """
+        Copy of the newest n readings in the order they were taken. Only the requested window is copied.
+
+        :param n: Number of readings
+        :type n: int
+        :return: Newest readings
+        :rtype: np.ndarray
+        """
+        with self.lock:
+            n = int(min(n, self.count, len(self.data)))
+            start = self.index - n
+            if start >= 0:
+                return self.data[start:self.index].copy()
+            return np.concatenate((self.data[start:], self.data[:self.index]))
+
+
+class Driver(VISA_Driver):
+    """
+    This class implements the Keysight 34465A digital multimeter driver. Instead of one :READ? round trip per reading,
+    the driver lets the instrument fill its reading memory with all the samples needed for one point and then fetches
+    the whole buffer in a single binary (REAL,64) transfer.
+    """
+
+    # Quantities that return a single number of the currently selected function (mean of the acquired buffer)
+    reading_quantities = ["Voltage", "Current", "Resistance"]
+    # Quantities that are calculated from the same acquired buffer
+    buffer_quantities = ["Reading trace", "Reading mean", "Reading std"]
+    # Quantities calculated from the window of newest streamed readings
+    stream_quantities = ["Stream mean", "Stream RMS", "Stream PSD", "Stream readings"]
+    # Quantities that are used only by the driver, nothing is sent to the instrument when they are set
+    driver_quantities = ["Samples per point", "Acquisition mode", "Stream window", "Triggered readings",
+                         "Trigger timeout", "Integration mode", "Noise target", "Noise estimate readings"]
+    # Quantities used only by the driver that require the stream to be restarted when changed
+    stream_settings = ["Stream sample interval", "Stream buffer size"]
+
+    # Time to wait between two checks of the number of readings stored in the instrument memory
+    poll_interval = 0.005
+    # Time to wait between two reads of the streamed readings, instrument memory (50000 readings) has to last longer
+    stream_drain_interval = 0.05
+    stream_chunk = 50000
+
+    # NPLC command prefix, range and auto-range quantities of the functions that integrate (AC functions do not)
+    nplc_functions = {"Voltage DC": ("VOLT:DC", "Range (V_dc)", "Auto-range (V_dc)"),
+                      "Current DC": ("CURR:DC", "Range (I_dc)", "Auto-range (I_dc)"),
+                      "Resistance (2-wire)": ("RES", "Range (R-2w)", "Auto-range (R-2w)"),
+                      "Resistance (4-wire)": ("FRES", "Range (R-4w)", "Auto-range (R-4w)")}
+    # Integration times (in power line cycles) available in the auto integration mode, from fastest to slowest
+    nplc_values = [0.02, 0.2, 1.0, 10.0, 100.0]
+
+    def performOpen(self, options={}):
+        """
+        Perform the operation of opening the instrument connection. After the generic VISA open the data format is
+        switched to 64 bit binary with little endian byte order, so that buffers can be decoded by numpy directly.
+
+        :param options:
+        :return: NoneType
+        """
+        VISA_Driver.performOpen(self, options=options)
+
+        self.write(":FORM:DATA REAL,64")
+        self.write(":FORM:BORD SWAP")
+        self.reading_buffer = None
+        # number of readings of an acquisition that was started but not fetched yet (0 if nothing is running)
+        self.armed_samples = 0
+        # same for the acquisition that takes one reading per external trigger
+        self.triggered_samples = 0
+        self.triggered_buffer = None
+        # integration time selected by the auto integration mode for every (function, range) pair
+        self.nplc_cache = {}
+        self.active_nplc = None
+
+        # streaming thread shares the VISA session with the rest of the driver
+        self.stream_lock = threading.Lock()
+        self.stream_stop = threading.Event()
+        self.stream_thread = None
+        self.stream_buffer = None
+        self.stream_interval = 0.0
+
+    def performClose(self, bError=False, options={}):
+        """
+        Perform the close instrument connection operation. Streaming is stopped first so the background thread does not
+        talk to a closed session.
+
+        :param bError:
+        :param options:
+        :return: NoneType
+        """
+        self.stop_streaming()
+        VISA_Driver.performClose(self, bError, options)
+
+    def performSetValue(self, quant, value, sweepRate=0.0, options={}):
+        """
+        Perform the Set Value instrument operation. This function should return the actual value set by the instrument
+
+        :param quant: Quantity object (I believe Labber has some kind of object representing quantities)
+        :type quant:
+        :param value: Value to which the quantity is being set to
+        :type value: int | float | str | bool
+        :param sweepRate:
+        :type sweepRate:
+        :param options:
+        :return: Value that has been passed to this method as the value we want to set the quantity to
+        :rtype: None | int | float | str | bool
+        """
+        if quant.name == "Streaming":
+            if value:
+                self.start_streaming()
+            else:
+                self.stop_streaming()
+            return value
+
+        if quant.name == "Arm triggered acquisition":
+            self.stop_streaming()
+            self.armed_samples = 0
+            self.arm_triggered_acquisition(int(self.getValue("Triggered readings")))
+            return value
+
+        # changing the configuration while the instrument is waiting to integrate would measure with old settings
+        if self.armed_samples:
+            self.write(":ABOR")
+            self.armed_samples = 0
+
+        if quant.name in ["Noise target", "Noise estimate readings"]:
+            self.nplc_cache = {}
+        elif quant.name == "Integration mode" and value == "Fixed":
+            # put back the integration times selected by the user
+            for name in ["Integration time (V_dc)", "Integration time (I_dc)", "Integration time (R-2w)",
+                         "Integration time (R-4w)"]:
+                self.sendValueToOther(name, self.getValue(name))
+        if quant.name not in self.driver_quantities:
+            # any instrument setting can change the integration time, make the auto mode send it again
+            self.active_nplc = None
+            # configuration can not change while the instrument is streaming, restart the stream around the change
+            streaming = self.stream_thread is not None
+            self.stop_streaming()
+            if quant.name in self.stream_settings:
+                quant.setValue(value)
+            else:
+                value = VISA_Driver.performSetValue(self, quant, value, sweepRate, options)
+            if streaming:
+                self.start_streaming()
+        return value
+
+    def performArm(self, quant_names, options={}):
+        """
+        Perform the instrument arm operation. Labber calls this after all the values of a step are set and before
+        any of the values are read. In overlapped mode the acquisition is started here, so the instrument integrates
+        while Labber is busy with other instruments, and the readings are collected on the next get.
+
+        :param quant_names: Names of the quantities that are going to be read
+        :type quant_names: list
+        :param options:
+        :return: NoneType
+        """
+        if self.getValue("Acquisition mode") == "Overlapped" and not self.armed_samples and \
+                self.stream_thread is None and not self.triggered_samples:
+            self.start_point_acquisition()
+
+    def performGetValue(self, quant, options={}):
+        """
+        Perform the Get Value instrument operation. All reading quantities share one acquisition per call cycle, so
+        getting the mean, the standard deviation and the trace of the same point costs one transfer.
+
+        :param quant: Quantity object (I believe Labber has some kind of class representing quantities)
+        :type quant:
+        :param options:
+        :type options:
+        :return:
+        :rtype: None | int | float | str | bool | dict
+        """
+        if self.isFirstCall(options):
+            self.reading_buffer = None
+
+        if quant.name in self.stream_quantities:
+            return self.get_stream_value(quant)
+
+        if quant.name == "Triggered trace":
+            if self.triggered_samples:
+                self.triggered_buffer = self.fetch_triggered_acquisition()
+            if self.triggered_buffer is None:
+                return quant.getTraceDict([])
+            return quant.getTraceDict(self.triggered_buffer, t0=0.0, dt=1.0)
+
+        if quant.name in self.reading_quantities + self.buffer_quantities:
+            if self.stream_thread is not None:
+                # while streaming the reading memory belongs to the stream, use its newest window instead
+                self.reading_buffer = self.stream_buffer.latest(int(self.getValue("Stream window")))
+            elif self.reading_buffer is None and self.triggered_samples:
+                # a new acquisition would throw away the armed triggered acquisition, it is kept until it is fetched
+                self.log("{} is not measured while a triggered acquisition is armed, last value is returned".format(
+                    quant.name))
+                return quant.getValue()
+            elif self.reading_buffer is None:
+                if not self.armed_samples:
+                    self.start_point_acquisition()
+                self.reading_buffer = self.fetch_acquisition()
+            data = self.reading_buffer
+
+            if quant.name == "Reading trace":
+                return quant.getTraceDict(data, t0=0.0, dt=1.0)
+            elif quant.name == "Reading std":
+                return np.std(data, ddof=1) if len(data) > 1 else 0.0
+            else:
+                return np.mean(data)
+
+        if quant.name == "Streaming":
+            return self.stream_thread is not None
+        if quant.name == "Selected NPLC":
+            return self.active_nplc if self.active_nplc is not None else 0.0
+
+        with self.stream_lock:
+            value = VISA_Driver.performGetValue(self, quant, options)
+        return value
+
+    def acquire(self, samples):
+        """
+        Take a number of readings with one trigger and fetch them all in one transfer. The instrument stores the
+        readings in its reading memory, we check how many are stored (cheap query, no data transfer) and remove them
+        from the memory all at once when the acquisition is done.
+
+        :param samples: Number of readings to take
+        :type samples: int
+        :return: Readings taken by the instrument
+        :rtype: np.ndarray
+        """
+        self.start_acquisition(samples)
+        return self.fetch_acquisition()
+
+    def start_point_acquisition(self):
+        """
+        Start the acquisition of one measurement point, with the integration time selected by the auto integration
+        mode if it is enabled.
+
+        :return: NoneType
+        """
+        if self.getValue("Integration mode") == "Auto":
+            self.select_integration_time()
+        self.start_acquisition(int(self.getValue("Samples per point")))
+
+    def start_acquisition(self, samples):
+        """
+        Configure the number of readings and start the measurement without waiting for it to finish.
+
+        :param samples: Number of readings to take
+        :type samples: int
+        :return: NoneType
+        """
+        self.write(":SAMP:COUN {};:TRIG:COUN 1;:INIT".format(samples))
+        self.armed_samples = samples
+
+    def fetch_acquisition(self):
+        """
+        Wait for the running acquisition to finish and fetch its readings.
+
+        :return: Readings taken by the instrument
+        :rtype: np.ndarray
+        """
+        samples = self.armed_samples
+        self.armed_samples = 0
+        return self.remove_readings(self.wait_for_readings(samples))
+
+    def select_integration_time(self):
+        """
+        Configure the smallest integration time that meets the noise target for the current function and range. The
+        choice is estimated once for every (function, range) pair and cached, so it is only revisited when the range
+        (or the noise target) changes.
+
+        :return: NoneType
+        """
+        function = self.getValue("Function")
+        if function not in self.nplc_functions:
+            return
+        prefix, range_quant, auto_range_quant = self.nplc_functions[function]
+        if self.getValue(auto_range_quant) == "On":
+            key = (function, "Auto")
+        else:
+            key = (function, self.getValue(range_quant))
+
+        if key not in self.nplc_cache:
+            self.nplc_cache[key] = self.estimate_integration_time(prefix)
+            self.active_nplc = self.nplc_cache[key]
+        if self.active_nplc != self.nplc_cache[key]:
+            self.write(":{}:NPLC {}".format(prefix, self.nplc_cache[key]))
+            self.active_nplc = self.nplc_cache[key]
+
+    def estimate_integration_time(self, prefix):
+        """
+        Find the smallest NPLC whose noise (standard deviation of a short burst of readings) is below the noise target.
+        White noise averages down as 1/sqrt(integration time), so after each burst the settings that can not reach the
+        target are skipped instead of measured.
+
+        :param prefix: NPLC command prefix of the current function (VOLT:DC, CURR:DC, RES or FRES)
+        :type prefix: str
+        :return: Selected NPLC, it is also left configured on the instrument
+        :rtype: float
+        """
+        target = self.getValue("Noise target")
+        samples = int(self.getValue("Noise estimate readings"))
+
+        nplc = self.nplc_values[0]
+        while True:
+            self.write(":{}:NPLC {}".format(prefix, nplc))
+            noise = np.std(self.acquire(samples), ddof=1)
+            if noise <= target or nplc == self.nplc_values[-1]:
+                return nplc
+            required = nplc * (noise / target) ** 2
+            slower = [value for value in self.nplc_values if value > nplc]
+            nplc = next((value for value in slower if value >= required), self.nplc_values[-1])
+
+    def arm_triggered_acquisition(self, samples):
+        """
+        Arm an acquisition that takes one reading on every external trigger. Readings stay in the reading memory until
+        the whole trace is fetched, so a sweep of a source that sends the triggers needs no DMM traffic per point.
+
+        :param samples: Number of triggers (and readings) to expect
+        :type samples: int
+        :return: NoneType
+        """
+        self.write(":ABOR;:TRIG:SOUR EXT;:TRIG:COUN {};:SAMP:COUN 1;:INIT".format(samples))
+        self.triggered_samples = samples
+
+    def fetch_triggered_acquisition(self):
+        """
+        Wait for the armed triggered acquisition to finish (or the trigger timeout to pass), fetch all of its readings
+        in one transfer and return the instrument to immediate triggering.
+
+        :return: Readings taken on the external triggers
+        :rtype: np.ndarray
+        """
+        samples = self.triggered_samples
+        self.triggered_samples = 0
+        available = self.wait_for_readings(samples, self.getValue("Trigger timeout"))
+        if available < samples:
+            self.log("Triggered acquisition received {} of {} triggers".format(available, samples))
+        data = self.remove_readings(available)
+        self.write(":ABOR;:TRIG:SOUR IMM")
+        return data
+
+    def wait_for_readings(self, samples, timeout=None):
+        """
+        Wait until the reading memory contains at least the specified number of readings.
+
+        :param samples: Number of readings we are waiting for
+        :type samples: int
+        :param timeout: Maximum time to wait in seconds, None to wait until the measurement is stopped
+        :type timeout: float
+        :return: Number of readings in the memory (less than samples if the wait was interrupted)
+        :rtype: int
+        """
+        start = time.time()
+        while True:
+            available = int(float(self.askAndLog(":DATA:POIN?")))
+            if available >= samples:
+                return samples
+            if self.isStopped() or (timeout is not None and time.time() - start > timeout):
+                self.write(":ABOR")
+                return available
+            self.wait(self.poll_interval)
+
+    def remove_readings(self, samples):
+        """
+        Remove the specified number of readings from the reading memory and return them.
+
+        :param samples: Maximum number of readings to remove from the memory
+        :type samples: int
+        :return: Readings removed from the instrument memory
+        :rtype: np.ndarray
+        """
+        if samples == 0:
+            return np.array([])
+        self.write(":DATA:REM? {}".format(samples))
+        return self.read_binary_block()
+
+    def read_binary_block(self):
+        """
+        Read an IEEE 488.2 definite length block (#<number of digits><number of bytes><data>) from the instrument and
+        decode it as an array of little endian doubles. Bytes are read by count, so a data byte that happens to be
+        equal to the termination character does not end the read.
+
+        :return: Decoded block
+        :rtype: np.ndarray
+        """
+        header = self.com.read_bytes(2)
+        number_of_digits = int(header[1:2])
+        number_of_bytes = int(self.com.read_bytes(number_of_digits))
+        # block is followed by the line terminator
+        data = self.com.read_bytes(number_of_bytes + 1)
+        return np.frombuffer(data[:number_of_bytes], dtype="<f8")
+
+    def start_streaming(self):
+        """
+        Start a continuous data logger acquisition. The instrument takes readings at a fixed sample interval and a
+        background thread drains them from the reading memory (R?) into a preallocated ring buffer.
+
+        :return: NoneType
+        """
+        if self.stream_thread is not None:
+            return
+        self.armed_samples = 0
+        self.triggered_samples = 0
+        self.write(":ABOR")
+        self.write(":TRIG:SOUR IMM;:TRIG:COUN 1;:SAMP:SOUR TIM;:SAMP:TIM {};:SAMP:COUN 1E9".format(
+            self.getValue("Stream sample interval")))
+        # instrument rounds the interval to what it can do, PSD frequencies have to use the real one
+        self.stream_interval = float(self.askAndLog(":SAMP:TIM?"))
+        self.stream_buffer = ReadingRingBuffer(self.getValue("Stream buffer size"))
+        self.write(":INIT")
+
+        self.stream_stop.clear()
+        self.stream_thread = threading.Thread(target=self.stream_worker)
+        self.stream_thread.daemon = True
+        self.stream_thread.start()
+
+    def stop_streaming(self):
+        """
+        Stop the background thread and the acquisition on the instrument. Readings already in the ring buffer are kept
+        until the next stream is started.
+
+        :return: NoneType
+        """
+        if self.stream_thread is None:
+            return
+        self.stream_stop.set()
+        self.stream_thread.join()
+        self.stream_thread = None
+        self.write(":ABOR;:SAMP:SOUR IMM")
+
+    def stream_worker(self):
+        """
+        Body of the background thread. Readings are removed from the instrument memory in binary blocks as they arrive
+        and appended to the ring buffer.
+
+        :return: NoneType
+        """
+        while not self.stream_stop.is_set():
+            try:
+                with self.stream_lock:
+                    self.write(":R? {}".format(self.stream_chunk))
+                    data = self.read_binary_block()
+            except Exception as e:
+                self.log("Streaming stopped: " + str(e))
+                return
+            self.stream_buffer.extend(data)
+            self.stream_stop.wait(self.stream_drain_interval)
+
+    def get_stream_value(self, quant):
+        """
+        Calculate the statistics of the newest window of streamed readings.
+
+        :param quant: One of the stream quantities
+        :return: Value of the quantity
+        :rtype: float | dict
+        """
+        if self.stream_buffer is None:
+            if quant.name == "Stream PSD":
+                return quant.getTraceDict([])
+            return 0.0
+        if quant.name == "Stream readings":
+            return self.stream_buffer.count
+
+        data = self.stream_buffer.latest(int(self.getValue("Stream window")))
+        if len(data) == 0:
+            if quant.name == "Stream PSD":
+                return quant.getTraceDict([])
+            return 0.0
+
+        if quant.name == "Stream mean":
+            return np.mean(data)
+        elif quant.name == "Stream RMS":
+            return np.sqrt(np.mean(data ** 2))
+        else:
+            # one sided power spectral density of the window (Hann window, mean removed)
+            window = np.hanning(len(data))
+            spectrum = np.fft.rfft((data - np.mean(data)) * window)
+            psd = 2 * np.abs(spectrum) ** 2 * self.stream_interval / np.sum(window ** 2)
+            psd[0] /= 2
+            df = 1.0 / (len(data) * self.stream_interval)
+            return quant.getTraceDict(psd, t0=0.0, dt=df)
@@ -5,6 +5,7 @@ import os.path
 import logging
 import socket
 import time
+from concurrent.futures import ThreadPoolExecutor
 from BaseDriver import LabberDriver
 
 
@@ -22,7 +23,30 @@ class Driver(LabberDriver):
     y_magnet_PORT = 7180
 
     BUFFSIZE = 1024
+    # Every reply of the instrument ends with this terminator, commands end with a line feed
+    TERMINATOR = b"\r\n"
+    # Maximum time (seconds) to wait for the reply to a query
+    reply_timeout = 2.0
+    # Unread data (welcome message, late replies) is considered complete after the instrument is silent this long (s)
+    banner_timeout = 0.3
+    # Shortest and longest time (seconds) between two status polls while waiting for a ramp
+    min_poll_interval = 0.05
+    max_poll_interval = 5.0
+    # Part of the predicted time until the ramp is finished to sleep before polling again
+    poll_fraction = 0.5
+    # The reactive ramping algorithm checks the field this long (seconds) before it is predicted to cross a threshold
+    threshold_lead_time = 0.2
+    # Field (T) that differs from the predicted one by more than this is unexpected, both magnets are paused
+    prediction_tolerance = 0.05
+    # Next set point of a rotation is sent when the magnets are this close (seconds) to the current one
+    rotation_lead_time = 0.5
+    # Queries of the status record, sent in one line and answered in this order
+    status_queries = ["STATE?", "FIELD:MAG?", "FIELD:TARG?", "PERS?", "QU?", "PS?"]
     CONNECTED_MAGNETS = {"z": False, "y": False}
+    # Field rating (T) of the z and y magnet, used as the upper field of the ramp rate segment
+    field_ratings = {"z": 8.99, "y": 2.99}
+    # Slowest ramp rate (T/s) used when the rates of both magnets are matched to the length of a move
+    min_ramp_rate = 1e-5
 
     radius = 0
     phi = 0
@@ -48,6 +72,14 @@ class Driver(LabberDriver):
         :return: all magnets which we successfully connected to
         :rtype: tuple
         """
+        # ramp rate last sent to every magnet socket, see use_ramp_rate
+        self.ramp_rates = {}
+        # bytes received after the last complete reply, for every magnet socket
+        self.receive_buffers = {}
+        # rotation in progress (see start_rotation), None if phi is not being swept
+        self.rotation = None
+        # one worker per magnet, so both supplies can be queried at the same time
+        self.poll_pool = ThreadPoolExecutor(max_workers=2)
         try:
             self.z_magnet_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.z_magnet_socket.settimeout(0.6)
@@ -56,7 +88,8 @@ class Driver(LabberDriver):
             print(str(e))
         else:
             self.CONNECTED_MAGNETS["z"] = True
-            self._receive(self.z_magnet_socket)
+            # welcome message is not a reply to any query
+            self._flush(self.z_magnet_socket)
         try:
             self.y_magnet_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.y_magnet_socket.settimeout(0.6)
@@ -65,7 +98,8 @@ class Driver(LabberDriver):
             print(str(e))
         else:
             self.CONNECTED_MAGNETS["y"] = True
-            self._receive(self.y_magnet_socket)
+            # welcome message is not a reply to any query
+            self._flush(self.y_magnet_socket)
 
         return self.CONNECTED_MAGNETS
 
@@ -75,6 +109,7 @@ class Driver(LabberDriver):
 
         :return: NoneType
         """
+        self.poll_pool.shutdown()
         self.z_magnet_socket.close()
         self.y_magnet_socket.close()
 
@@ -112,15 +147,23 @@ class Driver(LabberDriver):
             socket = self.y_magnet_socket
         else:
             # This will happen when i try to perform a command involving more then 1 magnet
-            if quant.name == "radius":
+            if quant.name == "phi" and sweepRate != 0:
+                return self.start_rotation(value, sweepRate)
+            elif quant.name == "radius":
                 return self.set_radius(value)
             elif quant.name == "phi":
                 return self.set_phi(value)
             elif quant.name == "constant_phi":
                 return self.set_constant_phi(value)
+            elif quant.name == "radius_tolerance":
+                return value
             else:
                 pass
 
+        # vector moves change the ramp rates of both magnets, single magnet moves ramp at the configured rate
+        if quant.name[2:] in ("current", "field", "setPoint", "ramp"):
+            self.use_ramp_rate(socket, self.getValue(quant.name[0] + "_rampRate"), fieldrating)
+
         if quant.name[2:] == "pSwitch":
             self.set_p_switch(socket, value)
         elif quant.name[2:] == "current":
@@ -149,6 +192,35 @@ class Driver(LabberDriver):
 
         return value
 
+    def checkIfSweeping(self, quant, options={}):
+        """
+        Called by Labber while a quantity is being swept. Rotations are driven from here: every call checks the field
+        and sends the next set point when the magnets get close to the current one.
+
+        :param quant: Quantity that is being swept
+        :type quant:
+        :param options:
+        :return: True if the sweep is still running
+        :rtype: bool
+        """
+        if self.rotation is None or quant.name != "phi":
+            return False
+        return self.advance_rotation()
+
+    def performStopSweep(self, quant, options={}):
+        """
+        Called by Labber when a sweep is stopped before reaching the end. Both magnets are paused at the current field.
+
+        :param quant: Quantity that is being swept
+        :type quant:
+        :param options:
+        :return: NoneType
+        """
+        if self.rotation is not None:
+            self.rotation = None
+            self.pause_ramp(self.z_magnet_socket)
+            self.pause_ramp(self.y_magnet_socket)
+
     def performGetValue(self, quant, options={}):
         """
         This method is called when we are trying to get the value of any of the isntruments quantities. Depending on the
@@ -179,6 +251,8 @@ class Driver(LabberDriver):
                 return self.get_phi()
             elif quant.name == "constant_phi":
                 return self.get_constant_phi()
+            elif quant.name == "radius_tolerance":
+                return self.getValue(quant.name)
             else:
                 pass
 
@@ -210,10 +284,10 @@ class Driver(LabberDriver):
     # ##### INSTRUMENT COMMUNICATION #####
     # ####################################
     """
-    def _send(self, magnet_socket, command):  # ##TODO: check for timeout and throw exception
+    def _send(self, magnet_socket, command):
         """
-        Send a command to a magnet specified by its socket. After sending a command sleep for 0.6 seconds to give magnet
-        time to do the required action.
+        Send a command to a magnet specified by its socket. Commands are terminated by a line feed, the instrument
+        processes them in the order they arrive so there is no need to wait after sending.
 
         :param magnet_socket: Socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
                                     directions is controled by a unique instrument and they have to be specified by
@@ -222,36 +296,115 @@ class Driver(LabberDriver):
         :return: NoneType
         """
         magnet_socket.sendall(bytes(command, "ASCII"))
-        time.sleep(0.6)  # ##Temporary solution for too fast computers
         return
 
-    def _receive(self, magnet_socket):
+    def _receive(self, magnet_socket, timeout=None):
         """
-        Read the data from the instruments standard event buffer. When a command is sent to an instrument the response
-        is stored in the standard event buffer. In order to obtain  the result from the instrument we have to read this
-        buffer.
+        Read one reply from the instrument. Bytes are collected until the reply terminator arrives, anything received
+        after the terminator is kept for the next reply.
 
         :param magnet_socket: Socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
                                     directions is controled by a unique instrument and they have to be specified by
                                     their socket.
-        :return: String: Content of the instruments standard event buffer after sending the command
-        """
-        return magnet_socket.recv(self.BUFFSIZE)
-
-    def _ask(self, magnet_socket, command):
-        """
-        Send a command and instantly read a reply from the instrument. To be used when getting an instrument value.
-        First we send a command to query some instrument value, instrument replies by setting that value in the
-        standard event buffer. Then we read and return the value from the standard event buffer.
+        :param timeout: Maximum time to wait for the reply in seconds, reply_timeout if None
+        :type timeout: float
+        :return: String: Reply of the instrument without the terminator
+        """
+        deadline = time.time() + (self.reply_timeout if timeout is None else timeout)
+        buffer = self.receive_buffers.get(magnet_socket, b"")
+        while self.TERMINATOR not in buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                # a late reply would be read as the reply to the next query, throw away everything that is left
+                self._flush(magnet_socket)
+                raise socket.timeout("Magnet power supply did not reply in time")
+            magnet_socket.settimeout(remaining)
+            try:
+                data = magnet_socket.recv(self.BUFFSIZE)
+            except socket.timeout:
+                continue
+            if not data:
+                raise ConnectionError("Magnet power supply closed the connection")
+            buffer += data
+
+        reply, self.receive_buffers[magnet_socket] = buffer.split(self.TERMINATOR, 1)
+        return reply.decode("ASCII")
+
+    def _ask(self, magnet_socket, command, timeout=None):
+        """
+        Send a command and read the reply from the instrument. To be used when getting an instrument value. The time it
+        takes is the network round trip plus the time instrument needs to answer.
 
         :param magnet_socket: Socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
                                     directions is controled by a unique instrument and they have to be specified by
                                     their socket.
         :param command: string: A command that we are sending to an instrument
-        :return: String: Content of the instruments standard event buffer after sending the command
+        :param timeout: Maximum time to wait for the reply in seconds, reply_timeout if None
+        :type timeout: float
+        :return: String: Reply of the instrument without the terminator
         """
         self._send(magnet_socket, command)
-        return self._receive(magnet_socket)
+        return self._receive(magnet_socket, timeout)
+
+    def _send_many(self, magnet_socket, commands):
+        """
+        Send several commands in one line. The instrument accepts semicolon separated commands and executes them in
+        the given order, so a sequence like PAUSE;CONF:FIELD:TARG x;RAMP costs one network transfer.
+
+        :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
+                              directions is controlled by a unique instrument and they have to be specified by
+                              their socket.
+        :type magnet_socket: socket.socket
+        :param commands: Commands without terminators (ex. ["PAUSE", "RAMP"])
+        :type commands: list
+        :return: NoneType
+        """
+        self._send(magnet_socket, ";".join(commands) + "\n")
+        return
+
+    def _ask_many(self, magnet_socket, queries, timeout=None):
+        """
+        Send several queries in one line and return their replies in the same order. Replies are split on both
+        semicolons and terminators, so it does not matter if the instrument answers in one line or in one line per
+        query.
+
+        :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
+                              directions is controlled by a unique instrument and they have to be specified by
+                              their socket.
+        :type magnet_socket: socket.socket
+        :param queries: Queries without terminators (ex. ["STATE?", "FIELD:MAG?"])
+        :type queries: list
+        :param timeout: Maximum time to wait for each reply line in seconds, reply_timeout if None
+        :type timeout: float
+        :return: Replies of the instrument, one for every query
+        :rtype: list
+        """
+        replies = []
+        self._send_many(magnet_socket, queries)
+        while len(replies) < len(queries):
+            replies += self._receive(magnet_socket, timeout).split(";")
+        return replies
+
+    def _flush(self, magnet_socket):
+        """
+        Read and throw away everything the instrument sends until it stays silent for banner_timeout seconds.
+
+        :param magnet_socket: Specifies magnets socket.
+        :type magnet_socket: socket.socket
+        :return: Everything that was thrown away
+        :rtype: bytes
+        """
+        data = self.receive_buffers.pop(magnet_socket, b"")
+        magnet_socket.settimeout(self.banner_timeout)
+        try:
+            while True:
+                chunk = magnet_socket.recv(self.BUFFSIZE)
+                if not chunk:
+                    break
+                data += chunk
+        except socket.timeout:
+            pass
+        return data
 
     """
     # ####################################
@@ -274,14 +427,15 @@ class Driver(LabberDriver):
         :return: True if ready, False if not ready
         :rtype: bool
         """
-        if self.get_quench(magnet_socket):
+        status = self.get_status(magnet_socket)
+        if status["quench"]:
             logging.error(__name__ + ': Magnet quench')
             return False
-        elif self.get_persistent(magnet_socket):
+        elif status["persistent"]:
             logging.error(__name__ + ': Magnet set to persistent mode')
             return False
         else:
-            ramp_state = self.get_ramp_state(magnet_socket)
+            ramp_state = status["rampState"]
             if ramp_state == 3 or ramp_state == 4:
                 logging.error(__name__ + ': Magnet set to manual ramp')
                 return False
@@ -295,7 +449,7 @@ class Driver(LabberDriver):
                 logging.error(__name__ + ': Magnet quench')
                 return False
             elif ramp_state == 0:
-                if self.get_p_switch(magnet_socket):
+                if status["pSwitch"]:
                     return True
                 else:
                     logging.error(__name__ + ': Already ramping with switch heater off (persistent mode?)')
@@ -306,6 +460,44 @@ class Driver(LabberDriver):
                 logging.error(__name__ + ': Invalid status received')
                 return False
 
+    def next_poll_interval(self, remaining_time):
+        """
+        Time to sleep before the next status poll. Far from the end of the ramp the driver sleeps through most of the
+        predicted time, close to it polls get dense.
+
+        :param remaining_time: Predicted time until the ramp is finished (seconds)
+        :type remaining_time: float
+        :return: Time to sleep in seconds
+        :rtype: float
+        """
+        return min(max(remaining_time * self.poll_fraction, self.min_poll_interval), self.max_poll_interval)
+
+    def wait_for_ramp(self, magnet_socket):
+        """
+        Wait until the magnet stops ramping (to the set point or to zero). Every check is one status record, the wait
+        ends as soon as the ramp state is anything else than ramping.
+
+        :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
+                              directions is controlled by a unique instrument and they have to be specified by
+                              their socket.
+        :type magnet_socket: socket.socket
+        :return: True if the magnet is holding at the set point or at zero, False otherwise
+        :rtype: bool
+        """
+        ramp_rate = self.get_ramp_rate(magnet_socket)
+        while True:
+            if self.isStopped():
+                self.pause_ramp(magnet_socket)
+                return False
+            status = self.get_status(magnet_socket)
+            if status["rampState"] == 0:
+                remaining = abs(status["setPoint"] - status["field"])
+            elif status["rampState"] == 5:
+                remaining = abs(status["field"])
+            else:
+                return status["rampState"] in (1, 7)
+            time.sleep(self.next_poll_interval(remaining / ramp_rate))
+
     def start_ramping(self, magnet_socket):
         """
         Issue a RAMP state. Magnet will start ramping
@@ -348,6 +540,26 @@ class Driver(LabberDriver):
     # ####################################
     """
 
+    def get_status(self, magnet_socket):
+        """
+        Get the status record of a magnet: ramp state, field, set point, persistent flag, quench flag and switch heater.
+        All queries are sent in one line and the replies are parsed by position, so the record costs one round trip.
+
+        :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
+                              directions is controlled by a unique instrument and they have to be specified by
+                              their socket.
+        :type magnet_socket: socket.socket
+        :return: Dictionary with keys rampState, field, setPoint, persistent, quench and pSwitch
+        :rtype: dict
+        """
+        state, field, set_point, persistent, quench, p_switch = self._ask_many(magnet_socket, self.status_queries)
+        return {"rampState": int(state) - 1,
+                "field": float(field),
+                "setPoint": float(set_point),
+                "persistent": int(persistent) == 1,
+                "quench": int(quench) == 1,
+                "pSwitch": int(p_switch) == 1}
+
     def get_ramp_state(self, magnet_socket):
         """
         Get the current state of the ramp.
@@ -400,7 +612,7 @@ class Driver(LabberDriver):
                                     their socket.
         :return: Float: Current value of the ramp rate. Represents how fast is the value of field changing
         """
-        return float(str(self._ask(magnet_socket, "RAMP:RATE:FIELD:1?\n")).split(",", 1)[0][2:])
+        return float(self._ask(magnet_socket, "RAMP:RATE:FIELD:1?\n").split(",", 1)[0])
 
     def set_ramp_rate(self, magnet_socket, value, magnet_fieldrating):
         """
@@ -416,6 +628,25 @@ class Driver(LabberDriver):
         :return: NoneType
         """
         self._send(magnet_socket, "CONF:RAMP:RATE:FIELD 1, {}, {}\n".format(str(value), str(magnet_fieldrating)))
+        self.ramp_rates[magnet_socket] = value
+        return
+
+    def use_ramp_rate(self, magnet_socket, value, magnet_fieldrating):
+        """
+        Set the ramp rate, unless it is already the last rate sent to the magnet.
+
+        :param magnet_socket: Specifies magnets socket. Magnet can have more then 1 direction. Each of those
+                              directions is controlled by a unique instrument and they have to be specified by
+                              their socket.
+        :type magnet_socket: socket.socket
+        :param value: Ramp rate (T/s)
+        :type value: float
+        :param magnet_fieldrating: Field rating of the magnet
+        :type magnet_fieldrating: float
+        :return: NoneType
+        """
+        if self.ramp_rates.get(magnet_socket) != value:
+            self.set_ramp_rate(magnet_socket, value, magnet_fieldrating)
         return
 
     def get_field(self, magnet_socket):
@@ -427,7 +658,6 @@ class Driver(LabberDriver):
                                     their socket.
         :return: Float: Current value of the magnetic field.
         """
-        self.get_ramp_state(magnet_socket)
         return float(self._ask(magnet_socket, "FIELD:MAG?\n"))
 
     def set_field(self, magnet_socket, value):
@@ -439,15 +669,11 @@ class Driver(LabberDriver):
                                     directions is controled by a unique instrument and they have to be specified by
                                     their socket.
         :param value: Desired value for the field
-        :param magnet:
-        :return: NoneType
+        :return: True if the magnet reached the field, else False
+        :rtype: bool
         """
-        self.pause_ramp(magnet_socket)
-        self._send(magnet_socket, "CONF:FIELD:TARG {} ;".format(float(value)))
-        self.start_ramping(magnet_socket)
-        while not self.is_ready_to_ramp(magnet_socket):
-            time.sleep(1)
-        return True
+        self._send_many(magnet_socket, ["PAUSE", "CONF:FIELD:TARG {}".format(float(value)), "RAMP"])
+        return self.wait_for_ramp(magnet_socket)
 
     def set_set_point(self, magnet_socket, value):
         """
@@ -461,8 +687,7 @@ class Driver(LabberDriver):
         :type value: float
         :return: NoneType
         """
-        self.pause_ramp(magnet_socket)
-        self._send(magnet_socket, "CONF:FIELD:TARG {} ;".format(float(value)))
+        self._send_many(magnet_socket, ["PAUSE", "CONF:FIELD:TARG {}".format(float(value))])
 
     def get_set_point(self, magnet_socket):
         """
@@ -473,7 +698,6 @@ class Driver(LabberDriver):
                                     their socket.
         :return: Float: Current set point to which we are trying to ramp the field to.
         """
-        self.get_ramp_state(magnet_socket)
         return float(self._ask(magnet_socket, "FIELD:TARG?\n"))
 
     def get_current(self, magnet_socket):
@@ -502,9 +726,7 @@ class Driver(LabberDriver):
         :type value: float
         :return: NoneType
         """
-        self.pause_ramp(magnet_socket)
-        self._send(magnet_socket, "CONF:CURR:TARG {} ;".format(float(value)))
-        self.start_ramping(magnet_socket)
+        self._send_many(magnet_socket, ["PAUSE", "CONF:CURR:TARG {}".format(float(value)), "RAMP"])
         return
 
     def get_units(self, magnet_socket):
@@ -532,7 +754,7 @@ class Driver(LabberDriver):
         :type value: int
         :return: NoneType
         """
-        self._send(magnet_socket, "CONF:FIELD:UNITS {}".format(value))
+        self._send(magnet_socket, "CONF:FIELD:UNITS {}\n".format(value))
         return
 
     def get_quench(self, magnet_socket):
@@ -642,6 +864,32 @@ class Driver(LabberDriver):
     # ####################################
     """
 
+    def poll_magnets(self, method):
+        """
+        Call a getter for both magnets at the same time. Each magnet has its own socket, so the queries run in parallel
+        and the whole call takes as long as the slower supply instead of the sum of both.
+
+        :param method: Getter that takes a magnet socket as its only argument (ex. self.get_field)
+        :type method: callable
+        :return: Results for z and y magnet
+        :rtype: list
+        """
+        futures = [self.poll_pool.submit(method, magnet_socket)
+                   for magnet_socket in (self.z_magnet_socket, self.y_magnet_socket)]
+        return [future.result() for future in futures]
+
+    def get_vector_status(self):
+        """
+        Get the field and ramp state of both magnets, one status record per magnet, queried at the same time. The polar
+        getters and the ramping algorithms all read the field this way, so the values of both magnets always belong to
+        the same moment.
+
+        :return: z field, y field, z ramp state, y ramp state
+        :rtype: tuple
+        """
+        z_status, y_status = self.poll_magnets(self.get_status)
+        return z_status["field"], y_status["field"], z_status["rampState"], y_status["rampState"]
+
     def polar_to_cartesian(self, r, phi):
         """
         Method that takes Spherical coordinates that represent the current field, and returns cartesian coordinates
@@ -676,15 +924,20 @@ class Driver(LabberDriver):
         """
         Calculate the value of angle between x axis and the projection of radius on to the x-y plane. Since it only
         needs values of x and y fields, it gets those from the instruments and then calculates the angle. Formula used
-        for calculation is: phi = np.rad2deg(np.arctan2(y, x))
+        for calculation is: phi = np.rad2deg(np.arctan2(y, x)). The angle is unwrapped to the turn closest to the set
+        point of the running rotation (or to the last set phi), so a rotation past 180 degrees reads continuously.
 
         :return: Value of phi
         :rtype: float
         """
-        z = self.get_field(self.z_magnet_socket)
-        y = self.get_field(self.y_magnet_socket)
+        z, y = self.get_vector_status()[:2]
 
         phi = np.rad2deg(np.arctan2(y, z))
+        if self.rotation is not None:
+            reference = self.rotation["angles"][self.rotation["index"]]
+        else:
+            reference = self.phi
+        phi += 360 * round((reference - phi) / 360)
 
         return phi
 
@@ -698,8 +951,7 @@ class Driver(LabberDriver):
         :return: Value passed to this method (the one we want to set phi to)
         :rtype: float
         """
-        z = self.get_field(self.z_magnet_socket)
-        y = self.get_field(self.y_magnet_socket)
+        z, y = self.get_vector_status()[:2]
         target_angle = value
 
         r, phi = self.cartesian_to_polar(z, y)
@@ -712,6 +964,101 @@ class Driver(LabberDriver):
         self.set_constant_phi(value)
         return value
 
+    def start_rotation(self, value, sweep_rate):
+        """
+        Start a continuous rotation of the field from the current angle to value, at constant radius. The circle is
+        followed with straight segments, short enough that the field (which is smallest in the middle of a segment)
+        stays within radius_tolerance of the radius. Ramp rates of every segment are matched so both magnets arrive at
+        its end together, at the requested angular rate if the magnets can ramp that fast. Set points are sent from
+        checkIfSweeping without pausing the magnets between the segments.
+
+        :param value: Angle at the end of the rotation (degrees)
+        :type value: float
+        :param sweep_rate: Angular rate (degrees per second)
+        :type sweep_rate: float
+        :return: Angle at the end of the rotation
+        :rtype: float
+        """
+        z, y = self.get_vector_status()[:2]
+        radius, start = self.cartesian_to_polar(z, y)
+        if radius == 0:
+            return self.set_constant_phi(value)
+        # arctan2 gives (-180, 180], start from the turn of the last set phi so that a rotation from 180 to 360 does
+        # not go through 540 degrees
+        start += 360 * round((self.phi - start) / 360)
+
+        # sagitta of a segment spanning the angle a is radius * (1 - cos(a / 2))
+        tolerance = min(self.getValue("radius_tolerance"), radius)
+        max_step = np.rad2deg(2 * np.arccos(1 - tolerance / radius))
+        segments = max(int(np.ceil(abs(value - start) / max_step)), 1)
+        segment_time = abs(value - start) / abs(sweep_rate) / segments
+
+        max_rate_z = self.getValue("z_rampRate")
+        max_rate_y = self.getValue("y_rampRate")
+        angles = list(np.linspace(start, value, segments + 1)[1:])
+        points = []
+        rates = []
+        previous = (z, y)
+        for angle in angles:
+            point = self.polar_to_cartesian(radius, np.deg2rad(angle))
+            delta_z = abs(point[0] - previous[0])
+            delta_y = abs(point[1] - previous[1])
+            # segment takes longer if one of the magnets can not ramp fast enough
+            duration = max(segment_time, delta_z / max_rate_z, delta_y / max_rate_y)
+            points.append(point)
+            rates.append((max(delta_z / duration, self.min_ramp_rate), max(delta_y / duration, self.min_ramp_rate)))
+            previous = point
+
+        self.rotation = {"value": value, "angles": angles, "points": points, "rates": rates, "index": 0}
+        self.send_rotation_set_point()
+        return value
+
+    def send_rotation_set_point(self):
+        """
+        Send the ramp rates and the set point of the current segment of the rotation to both magnets, one line per
+        magnet. Magnets that are already ramping keep ramping, only their target changes.
+
+        :return: NoneType
+        """
+        index = self.rotation["index"]
+        targets = self.rotation["points"][index]
+        rates = self.rotation["rates"][index]
+        for magnet_socket, axis, target, rate in zip((self.z_magnet_socket, self.y_magnet_socket), ("z", "y"),
+                                                     targets, rates):
+            self._send_many(magnet_socket, ["CONF:RAMP:RATE:FIELD 1, {}, {}".format(rate, self.field_ratings[axis]),
+                                            "CONF:FIELD:TARG {}".format(float(target)), "RAMP"])
+            self.ramp_rates[magnet_socket] = rate
+
+    def advance_rotation(self):
+        """
+        Check the progress of the rotation. When the magnets are about to reach the current set point, the next one is
+        sent. Both magnets are paused if the field leaves the combined_field_limit or a magnet stops ramping for any
+        other reason than reaching its set point.
+
+        :return: True if the rotation is still running, False if it finished or was stopped
+        :rtype: bool
+        """
+        rotation = self.rotation
+        z, y, z_ramp_state, y_ramp_state = self.get_vector_status()
+        self.reportStatus("Y: {}, Z: {}".format(y, z))
+        if np.sqrt(z * z + y * y) > self.combined_field_limit or z_ramp_state not in (0, 1) or \
+                y_ramp_state not in (0, 1):
+            self.performStopSweep(None)
+            return False
+
+        index = rotation["index"]
+        target_z, target_y = rotation["points"][index]
+        rate_z, rate_y = rotation["rates"][index]
+        if index == len(rotation["points"]) - 1:
+            if z_ramp_state == 1 and y_ramp_state == 1:
+                self.rotation = None
+                self.set_constant_phi(rotation["value"])
+                return False
+        elif max(abs(target_z - z) / rate_z, abs(target_y - y) / rate_y) < self.rotation_lead_time:
+            rotation["index"] += 1
+            self.send_rotation_set_point()
+        return True
+
     def get_constant_phi(self):
         """
         Get the value of the helper variable constant phi. This variable is used to calculate the fields when setting
@@ -742,8 +1089,7 @@ class Driver(LabberDriver):
         :return: Current REAL value of the radius
         :rtype: float
         """
-        z = self.get_field(self.z_magnet_socket)
-        y = self.get_field(self.y_magnet_socket)
+        z, y = self.get_vector_status()[:2]
         return np.sqrt(z * z + y * y)
 
     def set_radius(self, value):
@@ -772,15 +1118,99 @@ class Driver(LabberDriver):
         :return: polar coordinates of the field
         :rtype: tuple
         """
-        z = self.get_field(self.z_magnet_socket)
-        y = self.get_field(self.y_magnet_socket)
+        z, y = self.get_vector_status()[:2]
 
         radius = np.sqrt(z * z + y * y)
         phi = np.rad2deg(np.arctan2(y, z))
 
         return radius, phi
 
+    def match_ramp_rates(self, z, y, target_z, target_y):
+        """
+        Ramp rates with which both magnets reach the target at the same time. The configured ramp rate of the magnet
+        that needs longer is kept, the other one is slowed down so the field moves along the straight line from the
+        current field to the target.
+
+        :param z: Current value of z field
+        :type z: float
+        :param y: Current value of y field
+        :type y: float
+        :param target_z: Z magnet will ramp to this value
+        :type target_z: float
+        :param target_y: Y magnet will ramp to this value
+        :type target_y: float
+        :return: Ramp rates of the z and y magnet
+        :rtype: tuple
+        """
+        rate_z = self.getValue("z_rampRate")
+        rate_y = self.getValue("y_rampRate")
+        duration = max(abs(target_z - z) / rate_z, abs(target_y - y) / rate_y)
+        if duration == 0:
+            return rate_z, rate_y
+        # a magnet that does not move keeps its rate, the instrument does not accept a rate of zero
+        if target_z != z:
+            rate_z = max(abs(target_z - z) / duration, self.min_ramp_rate)
+        if target_y != y:
+            rate_y = max(abs(target_y - y) / duration, self.min_ramp_rate)
+        return rate_z, rate_y
+
     def start_ramping_algorithm(self, target_z, target_y):
+        """
+        This method is used to change the result field of both magnets in any way. Ramp rates of both magnets are
+        matched to the move (see match_ramp_rates), so the field moves along a straight line. The largest field on a
+        straight line is at one of its ends, so if both the current field and the target are inside the
+        combined_field_limit both magnets ramp at the same time for the whole move. Otherwise the reactive algorithm is
+        used (see ramp_reactively).
+
+        :param target_y: Y magnet will ramp to this value
+        :type target_y: float
+        :param target_z: Z magnet will ramp to this value
+        :type target_z: float
+        :return: True if successful, else False
+        :rtype: bool
+        """
+        radius = np.sqrt(target_z * target_z + target_y * target_y)
+        if radius > self.combined_field_limit:
+            self.pause_ramp(self.z_magnet_socket)
+            self.pause_ramp(self.y_magnet_socket)
+            self.getValueFromUserDialog(value="Don't put anything here",
+                                        text="Field will exceed the maximum allowed value (sweep canceled)",
+                                        title="Burn after reading")
+            return False
+
+        z, y = self.get_vector_status()[:2]
+        if np.sqrt(z * z + y * y) > self.combined_field_limit:
+            logging.warning(__name__ + ': Field is outside the combined field limit, using the reactive ramping '
+                                       'algorithm')
+            return self.ramp_reactively(target_z, target_y)
+
+        rate_z, rate_y = self.match_ramp_rates(z, y, target_z, target_y)
+        self.pause_ramp(self.z_magnet_socket)
+        self.pause_ramp(self.y_magnet_socket)
+        self.use_ramp_rate(self.z_magnet_socket, rate_z, self.field_ratings["z"])
+        self.use_ramp_rate(self.y_magnet_socket, rate_y, self.field_ratings["y"])
+        self.set_set_point(self.z_magnet_socket, target_z)
+        self.set_set_point(self.y_magnet_socket, target_y)
+        self.start_ramping(self.z_magnet_socket)
+        self.start_ramping(self.y_magnet_socket)
+
+        while True:
+            z, y, z_ramp_state, y_ramp_state = self.get_vector_status()
+            radius = np.sqrt(z * z + y * y)
+            self.reportStatus("Y: {}, Z: {}".format(y, z))
+
+            if self.isStopped() or radius > self.combined_field_limit or \
+                    z_ramp_state not in (0, 1) or y_ramp_state not in (0, 1):
+                self.pause_ramp(self.z_magnet_socket)
+                self.pause_ramp(self.y_magnet_socket)
+                return False
+            if z_ramp_state == 1 and y_ramp_state == 1:
+                return True
+
+            # path is a straight line inside the limit, the next event is the end of the move
+            time.sleep(self.next_poll_interval(max(abs(target_z - z) / rate_z, abs(target_y - y) / rate_y)))
+
+    def ramp_reactively(self, target_z, target_y):
         """
         This method is used to change the result field of both magnets in any way. Since it is required to have some
         safety not all magnets will ramp at the same time. There are 2 important numbers in this method: first one is
@@ -790,6 +1220,10 @@ class Driver(LabberDriver):
         both magnets can ramp at the same time. If the field ever passes this value, we will stop ramping all magnets
         that are increasing the total value of the field. If there is no magnets that are decreasing the field, then we
         will start one by one magnet until we reach the desired value of the field.
+
+        Between two checks the driver sleeps until shortly before the next predicted event: a magnet reaching its set
+        point, or the field crossing one of the thresholds (see time_to_radius). Every check compares the field with
+        the prediction, both magnets are paused on any unexpected reading.
         TODO: Change limits (Radius, stop and restart threshold)
 
         :param target_y: Y magnet will ramp to this value
@@ -803,6 +1237,9 @@ class Driver(LabberDriver):
         radius = np.sqrt(target_z * target_z + target_y * target_y)
         self.pause_ramp(self.z_magnet_socket)
         self.pause_ramp(self.y_magnet_socket)
+        # magnets ramp one by one here, at their configured rates
+        self.use_ramp_rate(self.z_magnet_socket, self.getValue("z_rampRate"), self.field_ratings["z"])
+        self.use_ramp_rate(self.y_magnet_socket, self.getValue("y_rampRate"), self.field_ratings["y"])
 
         # Radius should never be more then 1T ( can be adjusted to anz other value for testing purposes)
         if radius > self.combined_field_limit:
@@ -814,8 +1251,7 @@ class Driver(LabberDriver):
             self.set_set_point(self.y_magnet_socket, target_y)
             self.set_set_point(self.z_magnet_socket, target_z)
 
-        z = self.get_field(self.z_magnet_socket)
-        y = self.get_field(self.y_magnet_socket)
+        z, y = self.get_vector_status()[:2]
         radius, phi = self.cartesian_to_polar(z, y)
 
         if radius < self.restart_all_threshold:
@@ -835,8 +1271,10 @@ class Driver(LabberDriver):
                 if np.abs(target_y) < np.abs(y):
                     self.start_ramping(self.y_magnet_socket)
 
-        z_ramp_state = self.get_ramp_state(self.z_magnet_socket)
-        y_ramp_state = self.get_ramp_state(self.y_magnet_socket)
+        rate_z = self.getValue("z_rampRate")
+        rate_y = self.getValue("y_rampRate")
+        # (time, z, y, velocity of z, velocity of y) of the last check, None if there is no prediction
+        track = None
 
         # loop that keeps checking if we left the the safe zone, and stop some magnets if we did
         # additionally it keeps checking if we went back to the safe zone and restarts the magnets
@@ -847,8 +1285,8 @@ class Driver(LabberDriver):
                 self.pause_ramp(self.z_magnet_socket)
                 return False
 
-            z = self.get_field(self.z_magnet_socket)
-            y = self.get_field(self.y_magnet_socket)
+            now = time.time()
+            z, y, z_ramp_state, y_ramp_state = self.get_vector_status()
             radius, phi = self.cartesian_to_polar(z, y)
             self.reportStatus("Y: {}, Z: {}".format(y, z))
 
@@ -858,6 +1296,17 @@ class Driver(LabberDriver):
                 self.pause_ramp(self.y_magnet_socket)
                 return False
 
+            if track is not None:
+                expected_z = self.predict_field(track[1], target_z, track[3], now - track[0])
+                expected_y = self.predict_field(track[2], target_y, track[4], now - track[0])
+                if abs(z - expected_z) > self.prediction_tolerance or abs(y - expected_y) > self.prediction_tolerance:
+                    self.pause_ramp(self.z_magnet_socket)
+                    self.pause_ramp(self.y_magnet_socket)
+                    logging.error(__name__ + ': Unexpected field (Y: {}, Z: {}), expected Y: {}, Z: {}'.format(
+                        y, z, expected_y, expected_z))
+                    return False
+            track = None
+
             # Count how many magnets are currently ramping
             number_of_magnets_currently_ramping = 0
 
@@ -921,8 +1370,7 @@ class Driver(LabberDriver):
                     if finished:
                         return True
 
-            z_ramp_state = self.get_ramp_state(self.z_magnet_socket)
-            y_ramp_state = self.get_ramp_state(self.y_magnet_socket)
+            z_ramp_state, y_ramp_state = self.poll_magnets(self.get_ramp_state)
 
             # Make sure the result field is close to zero when the measurement is done
             if z_ramp_state == 1 and y_ramp_state == 1:
@@ -930,3 +1378,67 @@ class Driver(LabberDriver):
                 self.pause_ramp(self.y_magnet_socket)
                 self.pause_ramp(self.z_magnet_socket)
                 return True
+            if z_ramp_state not in (0, 1, 2) or y_ramp_state not in (0, 1, 2):
+                self.pause_ramp(self.z_magnet_socket)
+                self.pause_ramp(self.y_magnet_socket)
+                logging.error(__name__ + ': Unexpected ramp state (Y: {}, Z: {})'.format(y_ramp_state, z_ramp_state))
+                return False
+
+            # next event is a magnet reaching its set point or the field crossing one of the thresholds
+            v_z = np.sign(target_z - z) * rate_z if z_ramp_state == 0 else 0.0
+            v_y = np.sign(target_y - y) * rate_y if y_ramp_state == 0 else 0.0
+            events = [self.time_to_radius(z, y, v_z, v_y, threshold)
+                      for threshold in (self.restart_all_threshold, self.stop_threshold, self.combined_field_limit)]
+            if v_z != 0:
+                events.append(abs(target_z - z) / rate_z)
+            if v_y != 0:
+                events.append(abs(target_y - y) / rate_y)
+            track = (now, z, y, v_z, v_y)
+            time.sleep(min(max(min(events) - self.threshold_lead_time, self.min_poll_interval),
+                           self.max_poll_interval))
+
+    def time_to_radius(self, z, y, v_z, v_y, radius):
+        """
+        Time until the field, moving with a constant velocity, reaches the given radius. It is the smallest positive
+        root of |(z, y) + (v_z, v_y) * t| = radius.
+
+        :param z: Current value of z field
+        :type z: float
+        :param y: Current value of y field
+        :type y: float
+        :param v_z: Ramp velocity of z field (T/s, signed)
+        :type v_z: float
+        :param v_y: Ramp velocity of y field (T/s, signed)
+        :type v_y: float
+        :param radius: Radius (T)
+        :type radius: float
+        :return: Time in seconds, inf if the field never reaches the radius
+        :rtype: float
+        """
+        a = v_z * v_z + v_y * v_y
+        b = z * v_z + y * v_y
+        c = z * z + y * y - radius * radius
+        discriminant = b * b - a * c
+        if a == 0 or discriminant < 0:
+            return np.inf
+        roots = [t for t in ((-b - np.sqrt(discriminant)) / a, (-b + np.sqrt(discriminant)) / a) if t > 0]
+        return min(roots) if roots else np.inf
+
+    def predict_field(self, field, target, velocity, elapsed):
+        """
+        Field of a magnet after ramping with a constant velocity for some time, the magnet stops at its set point.
+
+        :param field: Field at the beginning (T)
+        :type field: float
+        :param target: Set point of the magnet (T)
+        :type target: float
+        :param velocity: Ramp velocity (T/s, signed), 0 if the magnet does not ramp
+        :type velocity: float
+        :param elapsed: Time in seconds
+        :type elapsed: float
+        :return: Predicted field
+        :rtype: float
+        """
+        if velocity == 0:
+            return field
+        return field + velocity * min(elapsed, abs(target - field) / abs(velocity))